@@ -1,5 +1,9 @@
 import argparse
+import collections
+import concurrent.futures
 import contextlib
+import fnmatch
+import functools
 import glob
 import itertools
 import os
@@ -11,7 +15,6 @@ import sys
 import string
 import traceback
 import time
-import tempfile
 import requests
 import packaging.version
 
@@ -49,6 +52,80 @@ excepthook.verbose = True
 sys.excepthook = excepthook
 
 
+def _glob_names(names, pattern):
+    """
+    The names of the files that lib50 would include with pattern: everything it matches as
+    glob would, with directories expanded to the files in them. Mirrors lib50's globbing
+    over names rather than on disk, tests check that the two agree.
+    """
+    # Implicit recursive iff no / in pattern and starts with *
+    if "/" not in pattern and pattern.startswith("*"):
+        pattern = f"**/{pattern}"
+    pattern_parts = [part for part in pattern.split("/") if part not in ("", ".")]
+
+    files = set()
+    for name in names:
+        parts = pathlib.PurePosixPath(name).parts
+        # Match the file itself, or any directory containing it whose contents are not hidden
+        for i in range(len(parts), 0, -1):
+            if _glob_match(pattern_parts, parts[:i]):
+                files.add(name)
+                break
+            if parts[i - 1].startswith("."):
+                break
+    return files
+
+
+def _glob_match(pattern_parts, parts):
+    """Whether the path with parts matches the glob pattern with pattern_parts, like glob.glob(recursive=True)."""
+    if not pattern_parts:
+        return not parts
+
+    pattern_part, pattern_parts = pattern_parts[0], pattern_parts[1:]
+    if pattern_part == "**":
+        # Any number of directories that are not hidden
+        for i in range(len(parts) + 1):
+            if _glob_match(pattern_parts, parts[i:]):
+                return True
+            if i < len(parts) and parts[i].startswith("."):
+                return False
+        return False
+
+    if not parts:
+        return False
+    if not glob.has_magic(pattern_part):
+        return parts[0] == pattern_part and _glob_match(pattern_parts, parts[1:])
+    if parts[0].startswith(".") and not pattern_part.startswith("."):
+        return False
+    return fnmatch.fnmatchcase(parts[0], pattern_part) and _glob_match(pattern_parts, parts[1:])
+
+
+def _list_files(patterns, path):
+    """
+    Ask lib50 which files of path, a directory or just a file, should be included.
+    Returns the directory those files are in and their names, or None if path is a zip or
+    tar archive. lib50.files changes the working directory, so this runs in a process of its own.
+    """
+    path = pathlib.Path(path)
+    if _data._is_archive_file(path):
+        return None
+
+    try:
+        if path.is_file():
+            # lib50.files operates on a directory
+            # So create a tempdir if the path is just a file
+            with tempfile.TemporaryDirectory() as dir:
+                (pathlib.Path(dir) / path.name).touch()
+                included, excluded = lib50.files(patterns, root=dir)
+            return path.parent, included
+
+        included, excluded = lib50.files(patterns, require_tags=[], root=path)
+        return path, included
+    except lib50.Error as e:
+        # lib50's errors don't survive being sent back from a process as they are
+        raise _api.Error(str(e)) from None
+
+
 def partition(vals, pred):
     true = set()
     false = set()
@@ -58,8 +135,15 @@ def partition(vals, pred):
 
 
 class SubmissionFactory:
+    #: Executor used to read the files of submissions concurrently
+    Executor = concurrent.futures.ThreadPoolExecutor
+    #: Executor used to ask lib50 which files to include, concurrently
+    FilesExecutor = concurrent.futures.ProcessPoolExecutor
+
     def __init__(self):
         self.max_file_size = 1024 * 1024
+        self.max_workers = 16
+        self.split_archives = False
         self.patterns = []
         self.submissions = {}
 
@@ -71,56 +155,132 @@ class SubmissionFactory:
         pattern = lib50.config.TaggedValue(pattern, "exclude")
         self.patterns.append(pattern)
 
-    def _get(self, path, preprocessor, is_archive=False):
-        path = pathlib.Path(path)
-
-        # Ask lib50 which file(s) in path should be included
-        if path.is_file():
-            # lib50.files operates on a directory
-            # So create a tempdir if the path is just a file
-            with tempfile.TemporaryDirectory() as dir:
-                (pathlib.Path(dir) / path.name).touch()
-                included, excluded = lib50.files(self.patterns, root=dir)
-            path = path.parent
-        else:
-            included, excluded = lib50.files(self.patterns, require_tags=[], root=path)
-
-        # Filter out any non utf8 files
-        decodable, undecodable = partition(included, lambda fp: self._is_valid_utf8(path / fp))
+    def _discover(self, path, listing, keep=True):
+        """
+        Find the files in path that should be part of its submission, given the future
+        ``listing`` of ``_list_files(self.patterns, path)``. Returns for every submission in path,
+        just one unless path is an archive that is split, the submission's path, its included,
+        too large and undecodable files, and the text and digest of the included files if ``keep``.
+        Safe to call from multiple threads.
+        """
+        listing = listing.result()
+
+        if listing is None:
+            path = pathlib.Path(path)
+            contents = self._read_archive(path)
+            if not self.split_archives:
+                return [self._partition(path, contents, keep)]
+
+            # Every top-level directory of the archive is a submission of its own
+            split = collections.defaultdict(dict)
+            for fp, content in contents.items():
+                top, sep, name = fp.partition("/")
+                if sep:
+                    split[top][name] = content
+            return [self._partition(path / top, contents, keep) for top, contents in sorted(split.items())]
+
+        path, included = listing
+        return [self._partition(path, {fp: self._read(path / fp) for fp in included}, keep)]
+
+    def _read_archive(self, path):
+        """
+        Read the members of the zip or tar archive at path that should be included in one go,
+        rather than extracting it. Returns their contents by name, None for those too large.
+        """
+        contents = {}
+        for i, (fp, size, read) in enumerate(_data._iter_archive(path)):
+            if i >= lib50._api.DEFAULT_FILE_LIMIT:
+                raise lib50.TooManyFilesError(lib50._api.DEFAULT_FILE_LIMIT)
+            # Whether a member is included depends on its name only, so others are never read
+            if self._files([fp]):
+                contents[fp] = read() if size <= self.max_file_size else None
+        return contents
+
+    def _partition(self, path, contents, keep):
+        # Every file was read just once, large files (>self.max_file_size) not at all.
+        # Filter out those, then decode the rest just once, filtering out any non utf8 files
+        read, large = partition(contents, lambda fp: contents[fp] is not None)
+        texts = {}
+        for fp in read:
+            try:
+                texts[fp] = _data._decode(contents[fp])
+            except UnicodeDecodeError:
+                pass
+        small, undecodable = partition(read, lambda fp: fp in texts)
 
-        # Filter out any large files (>self.max_file_size)
-        small, large = partition(decodable, lambda fp: (path / fp).stat().st_size <= self.max_file_size)
+        kept = {fp: (texts[fp], _data._digest(contents[fp])) for fp in small} if keep else {}
+        return path, sorted(small), sorted(large), sorted(undecodable), kept
 
-        return _data.Submission(path, sorted(small),
-                                large_files=sorted(large),
-                                undecodable_files=sorted(undecodable),
-                                preprocessor=preprocessor,
-                                is_archive=is_archive)
+    def _files(self, names):
+        """
+        Like lib50.files, which of names, the members of an archive, should be included
+        according to the patterns. Matches the names themselves, as there is nothing on
+        disk to glob. Required files, as for a directory, are not required.
+        """
+        # Names that can't be encoded as utf8 are never included, as by lib50.files
+        names = {name for name in names if self._is_encodable(name)}
+
+        included = _glob_names(names, "*")
+        excluded = set()
+        for pattern in self.patterns:
+            pattern_path = pathlib.PurePosixPath(pattern.value)
+            if pattern_path.is_absolute() or ".." in pattern_path.parts or pattern.value.startswith("~"):
+                raise _api.Error(f"Cannot include/exclude paths outside the current directory, "
+                                 f"but such a path ({pattern.value}) was specified.")
+
+            if pattern.tag == "include":
+                new_included = _glob_names(names, pattern.value)
+                excluded -= new_included
+                included.update(new_included)
+            elif pattern.tag == "exclude":
+                new_excluded = _glob_names(names, pattern.value)
+                included -= new_excluded
+                excluded.update(new_excluded)
+        return included
 
     def get_all(self, paths, preprocessor, is_archive=False):
         """
         For every path, and every preprocessor, generate a Submission containing that path/preprocessor.
         Returns a list of lists of Submissions.
+        Files are read while finding which are utf8, so best call this within
+        ``_api.content_cache()``, such that what is read then is kept, not read again.
         """
+        # Files are discovered concurrently, submissions are created in order of paths
+        paths = list(paths)
+        content_cache = _data.File._content_cache
+        discover = functools.partial(self._discover, keep=content_cache is not None)
         subs = set()
-        for sub_path in paths:
-            subs.add(self._get(sub_path, preprocessor, is_archive))
-            _api.get_progress_bar().update()
+        with self.FilesExecutor(max_workers=max(1, min(self.max_workers, len(paths)))) as files_executor, \
+                self.Executor(max_workers=self.max_workers) as executor:
+            # Ask lib50 which files to include in processes, then read those files in threads
+            listings = [files_executor.submit(_list_files, self.patterns, path) for path in paths]
+            for discovered in executor.map(discover, paths, listings):
+                for path, small, large, undecodable, contents in discovered:
+                    # Keep what was read for tokenizing later, if there's a cache to keep it in
+                    for fp, (text, digest) in contents.items():
+                        content_cache.add(path / fp, text, digest)
+
+                    subs.add(_data.Submission(path, small,
+                                              large_files=large,
+                                              undecodable_files=undecodable,
+                                              preprocessor=preprocessor,
+                                              is_archive=is_archive))
+                _api.get_progress_bar().update()
         return subs
 
+    def _read(self, file_path):
+        """Read the file at file_path as bytes, or return None if it is too large to compare."""
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size > self.max_file_size:
+                return None
+            return f.read()
+
     @staticmethod
-    def _is_valid_utf8(file_path):
-        """
-        Check if file_path is valid utf-8.
-        f.read() is not performant since the entire file is read in before checking if it is valid utf8.
-        This function reads in the file in increasingly large blocks so that it can error out early if necessary.
-        """
+    def _is_encodable(name):
+        """Check if name can be encoded as utf-8."""
         try:
-            with open(file_path, encoding="utf8") as f:
-                blocksize = 64
-                while f.read(blocksize):
-                    blocksize *= 2;
-        except UnicodeDecodeError:
+            name.encode("utf8")
+        except UnicodeEncodeError:
             return False
         return True
 
@@ -298,6 +458,26 @@ def expand_patterns(patterns):
     return list(itertools.chain.from_iterable(map(lambda x: glob.glob(x, recursive=True) or [x], patterns)))
 
 
+def document_frequency(value):
+    """
+    Parse a document frequency, either a number of submissions (int) or a fraction
+    of all submissions (float).
+    """
+    try:
+        frequency = int(value)
+    except ValueError:
+        try:
+            frequency = float(value)
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"invalid document frequency: {value!r}")
+        if not 0 < frequency <= 1:
+            raise argparse.ArgumentTypeError(f"fraction of submissions should be in (0, 1], not {value}")
+    else:
+        if frequency < 1:
+            raise argparse.ArgumentTypeError(f"number of submissions should be at least 1, not {value}")
+    return frequency
+
+
 def check_version(package_name=__package__, timeout=5):
     """Check for newer version of the package on PyPI"""    
     if not __version__:
@@ -321,11 +501,29 @@ def main():
     parser = ArgParser(prog="compare50")
     parser.add_argument("submissions",
                         nargs="+",
-                        help="Paths to submissions to compare")
+                        help="Paths to submissions to compare, directories, files or zip/tar archives."
+                             " Every archive is a single submission, unless --split-archives is given.")
     parser.add_argument("-a", "--archive",
                         nargs="+",
                         default=[],
                         help="Paths to archive submissions. Archive submissions are not compared against other archive submissions, only against regular submissions.")
+    parser.add_argument("--split-archives",
+                        action="store_true",
+                        help="Treat every top-level directory of a zip/tar archive as a submission of its own,"
+                             " e.g. for a tarball holding all submissions of a semester."
+                             " Files at the top level of such an archive are ignored.")
+    parser.add_argument("--archive-cache",
+                        action="store",
+                        metavar="DIRECTORY",
+                        type=pathlib.Path,
+                        help="Directory in which to keep the fingerprints of archive submissions between runs."
+                             " These are reused for as long as the archive and the first pass are unchanged.")
+    parser.add_argument("--incremental",
+                        action="store",
+                        metavar="DIRECTORY",
+                        type=pathlib.Path,
+                        help="Directory in which to keep the state of the ranking phase, such that a later run"
+                             " over the same submissions plus some new ones only fingerprints and scores what is new.")
     parser.add_argument("-d", "--distro",
                         nargs="+",
                         default=[],
@@ -371,6 +569,12 @@ def main():
                         default=1024,
                         type=int,
                         help="maximum allowed file size in KiB (default 1024 KiB)")
+    parser.add_argument("--max-df",
+                        action="store",
+                        metavar="MAX_DF",
+                        type=document_frequency,
+                        help="ignore fingerprints found in more than MAX_DF submissions while ranking,"
+                             " either a number of submissions or a fraction of all submissions (e.g. 0.5)")
     parser.add_argument("--profile",
                         action="store_true",
                         help="profile compare50 (development only, requires line_profiler, implies debug)")
@@ -390,6 +594,7 @@ def main():
 
     # Set max file size in bytes
     submission_factory.max_file_size = args.max_file_size * 1024
+    submission_factory.split_archives = args.split_archives
 
     for attrib in ("submissions", "archive", "distro"):
         # Expand all patterns found in args.{submissions,archive,distro}
@@ -404,6 +609,14 @@ def main():
 
     preprocessor = _data.Preprocessor(passes[0].preprocessors)
 
+    # Only the first pass scores, and so indexes the archive
+    if args.archive_cache and hasattr(passes[0].comparator, "archive_cache"):
+        passes[0].comparator.archive_cache = args.archive_cache / passes[0].__name__
+    if args.max_df is not None and hasattr(passes[0].comparator, "max_df"):
+        passes[0].comparator.max_df = args.max_df
+    if args.incremental and hasattr(passes[0].comparator, "incremental"):
+        passes[0].comparator.incremental = args.incremental / passes[0].__name__
+
     if args.profile:
         args.debug = True
         profiler = profile
@@ -412,6 +625,8 @@ def main():
 
     if args.debug:
         _api.Executor = _api.FauxExecutor
+        SubmissionFactory.Executor = _api.FauxExecutor
+        SubmissionFactory.FilesExecutor = _api.FauxExecutor
 
     if args.output.exists():
         try:
@@ -430,7 +645,7 @@ def main():
             print("Quitting...")
             sys.exit(1)
 
-    with profiler():
+    with profiler(), _api.token_cache(), _api.content_cache():
         total = len(args.submissions) + len(args.archive) + len(args.distro)
         with _api.progress_bar("Preparing", total=total, disable=args.debug) as bar:
             # Collect all submissions, archive submissions and distro files
@@ -458,19 +673,15 @@ def main():
             termcolor.cprint(f"Done, no similarities found.", "yellow")
             return
 
-        # Get the matching spans, group them per submission
-        groups = []
-        pass_to_results = {}
-        for pass_ in passes:
-            with _api.progress_bar(f"Comparing ({pass_.__name__})", disable=args.debug):
-                preprocessor = _data.Preprocessor(pass_.preprocessors)
-                for sub in itertools.chain(subs, archive_subs, ignored_subs):
-                    object.__setattr__(sub, "preprocessor", preprocessor)
-                pass_to_results[pass_] = _api.compare(scores, ignored_files, pass_)
-
-        # Render results
-        with _api.progress_bar("Rendering", disable=args.debug):
-            index = _renderer.render(pass_to_results, dest=args.output)
+        # Compare and render on one process pool, shared by all passes
+        with _api.Executor() as executor:
+            # Get the matching spans, group them per submission, as they are rendered
+            pass_to_results = {pass_: _api.compare_lazily(scores, ignored_files, pass_, executor=executor)
+                               for pass_ in passes}
+
+            # Render results
+            with _api.progress_bar("Comparing and rendering", disable=args.debug):
+                index = _renderer.render(pass_to_results, dest=args.output, executor=executor)
 
     termcolor.cprint(
         f"Done! Visit file://{index.absolute()} in a web browser to see the results.", "green")
@@ -1,18 +1,23 @@
+import bisect
 import collections
+import collections.abc
 import contextlib
 import heapq
 import io
 import itertools
+import multiprocessing
+import sys
+import tempfile
 import time
 
-import intervaltree
+import numpy as np
 import tqdm
 
 import concurrent.futures
-from ._data import Submission, Span, Group, BisectList, Compare50Result
+from ._data import Submission, File, Span, Group, Compare50Result, ContentCache, Preprocessor, TokenCache
 
 
-__all__ = ["rank", "compare", "missing_spans", "expand", "progress_bar", "get_progress_bar", "Error"]
+__all__ = ["rank", "compare", "compare_lazily", "missing_spans", "expand", "progress_bar", "get_progress_bar", "token_cache", "content_cache", "Error"]
 
 
 class Error(Exception):
@@ -39,8 +44,12 @@ def rank(submissions, archive_submissions, ignored_files, pass_, n=50):
     Rank submissions, return the top ``n`` most similar pairs
     """
     scores = pass_.comparator.score(submissions, archive_submissions, ignored_files)
-    # Keep only top `n` submission matches
-    return heapq.nlargest(n, scores)
+    # Keep only top `n` submission matches, straight from the scores if they know how
+    try:
+        nlargest = scores.nlargest
+    except AttributeError:
+        return heapq.nlargest(n, scores)
+    return nlargest(n)
 
     # max_id = max((max(score.sub_a.id, score.sub_b.id) for score in scores))
     # matrix = np.zeros((max_id+1, max_id+1))
@@ -68,25 +77,24 @@ def compare(scores, ignored_files, pass_):
     list of :class:`compare50.compare50Result`\ s.
     """
 
+    return _results(scores, pass_.comparator.compare(scores, ignored_files), pass_)
+
+
+def _results(scores, comparisons, pass_):
+    r"""The :class:`Compare50Result`\ s of ``scores``, given their ``comparisons``."""
     missing_spans_cache = {}
     sub_match_to_ignored_spans = {}
     sub_match_to_groups = {}
 
-    for comparison in pass_.comparator.compare(scores, ignored_files):
+    for comparison in comparisons:
+        file_to_ignored_spans = comparison.ignored_spans
+        if not isinstance(file_to_ignored_spans, collections.abc.Mapping):
+            file_to_ignored_spans = _ignored_spans_by_file(comparison, missing_spans_cache)
+
         new_ignored_spans = []
         for sub in (comparison.sub_a, comparison.sub_b):
             for file in sub.files:
-                # Divide ignored_spans per file
-                ignored_spans_file = [span for span in comparison.ignored_spans
-                                           if span.file == file]
-
-                # Find all spans lost by preprocessors for file_a
-                if file not in missing_spans_cache:
-                    missing_spans_cache[file] = missing_spans(file)
-                ignored_spans_file.extend(missing_spans_cache[file])
-
-                # Flatten the spans (they could be overlapping)
-                new_ignored_spans += _flatten_spans(ignored_spans_file)
+                new_ignored_spans += file_to_ignored_spans.get(file, [])
 
         sub_match_to_ignored_spans[(comparison.sub_a, comparison.sub_b)] = new_ignored_spans
 
@@ -103,6 +111,130 @@ def compare(scores, ignored_files, pass_):
     return results
 
 
+def compare_lazily(scores, ignored_files, pass_, batch_size=32, executor=None):
+    r"""
+    :param scores: Scored submission pairs to be compared more granularly
+    :type scores: [:class:`compare50.Score`]
+    :param ignored_files: files containing distro code
+    :type ignored_files: {:class:`compare50.File`}
+    :param pass_: pass whose comparator should be use to compare the submissions
+    :type pass_: :class:`compare50.Pass`
+    :param batch_size: number of submission pairs to compare at once
+    :type batch_size: int
+    :param executor: executor for the comparator to run on, if it compares lazily
+    :returns: :class:`Compare50Result`\ s corresponding to each of the given scores
+    :rtype: Sequence of :class:`compare50.Compare50Result`
+
+
+    Like :func:`compare`, but each result is only computed once it is requested, together
+    with the rest of its batch. Only the last batch of results is kept, so the results are
+    best read in order, and let go of once used. If the comparator has an
+    ``iter_compare(scores, ignored_files, executor=None)`` method, the batches are read from
+    the one iterator it returns, so that what the comparator prepares for all pairs is reused.
+    That is kept until the last pair that needs it is compared, and is run on ``executor``,
+    such that lazy results of several passes can share one. Otherwise each batch is compared
+    on its own.
+    """
+    return _LazyResults(scores, ignored_files, pass_, batch_size, executor)
+
+
+class _LazyResults(collections.abc.Sequence):
+    def __init__(self, scores, ignored_files, pass_, batch_size, executor=None):
+        self.scores = scores
+        self.ignored_files = ignored_files
+        self.pass_ = pass_
+        self.batch_size = batch_size
+        self.executor = executor
+        self._batch = None
+        self._results = []
+        self._comparisons = None
+        self._next_batch = 0
+        self._subs = {file.submission for file in ignored_files}
+        for score in scores:
+            self._subs.update((score.sub_a, score.sub_b))
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if not -len(self) <= i < len(self):
+            raise IndexError("result index out of range")
+        i %= len(self)
+
+        batch, i = divmod(i, self.batch_size)
+        if batch != self._batch:
+            # Let go of the last batch before computing the next
+            self._batch, self._results = None, []
+            self._results = self._compare(batch)
+            self._batch = batch
+        return self._results[i]
+
+    def _compare(self, batch):
+        global _progress_bar
+
+        # Other passes may have been compared in the mean time, so set this pass' preprocessor
+        preprocessor = Preprocessor(self.pass_.preprocessors)
+        for sub in self._subs:
+            object.__setattr__(sub, "preprocessor", preprocessor)
+
+        # Whatever bar is showing is not about this batch
+        bar, _progress_bar = _progress_bar, _ProgressBar(disable=True)
+        try:
+            scores = self.scores[batch * self.batch_size:(batch + 1) * self.batch_size]
+            try:
+                iter_compare = self.pass_.comparator.iter_compare
+            except AttributeError:
+                return compare(scores, self.ignored_files, self.pass_)
+            return _results(scores, self._comparisons_of(batch, iter_compare), self.pass_)
+        finally:
+            _progress_bar = bar
+
+    def _comparisons_of(self, batch, iter_compare):
+        """The comparisons of ``batch``, read from the one iterator over all of them."""
+        # Going back means starting over
+        if self._comparisons is None or batch < self._next_batch:
+            # Comparators need not take an executor, unless they're given one
+            kwargs = {"executor": self.executor} if self.executor is not None else {}
+            self._comparisons, self._next_batch = iter_compare(self.scores, self.ignored_files, **kwargs), 0
+
+        # Skip over any batches in between
+        for _ in range(self._next_batch, batch):
+            collections.deque(itertools.islice(self._comparisons, self.batch_size), maxlen=0)
+        self._next_batch = batch + 1
+        comparisons = list(itertools.islice(self._comparisons, self.batch_size))
+
+        # Let a generator clean up (e.g. shut down its workers) once all is read
+        if self._next_batch * self.batch_size >= len(self.scores):
+            try:
+                self._comparisons.close()
+            except AttributeError:
+                pass
+            self._comparisons = None
+        return comparisons
+
+
+def _ignored_spans_by_file(comparison, missing_spans_cache):
+    """
+    Divide the ignored spans of a comparison per file, add the spans lost by the
+    preprocessor (cached per file in ``missing_spans_cache``) and flatten them.
+    """
+    file_to_spans = {file: [] for sub in (comparison.sub_a, comparison.sub_b) for file in sub.files}
+    for span in comparison.ignored_spans:
+        file_to_spans[span.file].append(span)
+
+    for file, spans in file_to_spans.items():
+        # Find all spans lost by preprocessors for file
+        if file not in missing_spans_cache:
+            missing_spans_cache[file] = missing_spans(file)
+        spans.extend(missing_spans_cache[file])
+
+        # Flatten the spans (they could be overlapping)
+        file_to_spans[file] = _flatten_spans(spans)
+    return file_to_spans
+
+
 def missing_spans(file, original_tokens=None, processed_tokens=None):
     """
     :param file: file to be examined
@@ -166,71 +298,57 @@ def expand(span_matches, tokens_a, tokens_b):
     if not span_matches:
         return span_matches
 
-    expanded_span_matches = set()
-
-    # Keep a list of tokens, sorted by the start (BisectList facilitates binary search)
-    tokens_a = BisectList.from_sorted(tokens_a, key=lambda tok: tok.start)
-    tokens_b = BisectList.from_sorted(tokens_b, key=lambda tok: tok.start)
-
-    # Keep track of the intervals of the file covered by spans so that we can
-    # avoid expanding span pairs that are already subsumed
-    span_tree_a = intervaltree.IntervalTree()
-    span_tree_b = intervaltree.IntervalTree()
-
-    # Sort span matches first, to ensure that, if there are contiguous identical spans, we
-    # start expanding the earliest span first.
-    span_matches = sorted(span_matches, key=lambda match: (match[0].start, match[1].start))
-
-    def is_subsumed(span, tree):
-        """Determine if span is contained by any interval in the tree.
-        Assumes that tree contains no intersecting intervals"""
-        return any(i.begin <= span.start and i.end >= span.end
-                       for i in tree[span.start:span.end])
-
-
-    def _expand_side(cursor_a, cursor_b, step):
-        """One-sided expansion. Given the start/end indices of a span pair,
-        expand token-wise moving along the list of tokens according to ``step``.
-
-        Returns a pair of indices corresponding to the new tokens"""
-
-        tok_idx_a = tokens_a.bisect_key_right(cursor_a) - 2
-        tok_idx_b = tokens_b.bisect_key_right(cursor_b) - 2
-
-        try:
-            while min(tok_idx_a, tok_idx_b) >= 0 and tokens_a[tok_idx_a] == tokens_b[tok_idx_b]:
-                tok_idx_a += step
-                tok_idx_b += step
-        except IndexError:
-            pass
-
-        tok_idx_a -= step
-        tok_idx_b -= step
-
-        return tok_idx_a, tok_idx_b
-
-
-    for span_a, span_b in span_matches:
-        if is_subsumed(span_a, span_tree_a) and is_subsumed(span_b, span_tree_b):
+    file_a, file_b = span_matches[0][0].file, span_matches[0][1].file
+
+    # Number the tokens such that two tokens have the same number if and only if they have
+    # the same value, as for the fingerprints these matches come from
+    token_ids = {}
+    ids_a = np.array([token_ids.setdefault(tok.val, len(token_ids)) for tok in tokens_a], dtype=np.int64)
+    ids_b = np.array([token_ids.setdefault(tok.val, len(token_ids)) for tok in tokens_b], dtype=np.int64)
+
+    # Turn each span into the range of tokens it covers
+    token_starts_a = np.array([tok.start for tok in tokens_a], dtype=np.int64)
+    token_starts_b = np.array([tok.start for tok in tokens_b], dtype=np.int64)
+    starts_a = np.searchsorted(token_starts_a, [span_a.start for span_a, _ in span_matches])
+    starts_b = np.searchsorted(token_starts_b, [span_b.start for _, span_b in span_matches])
+    ends_a = np.searchsorted(token_starts_a, [span_a.end for span_a, _ in span_matches])
+
+    # Any match on the same diagonal (offset between the tokens of a and b) as, and
+    # contained by, the span pair expanded last expands to that same span pair. So sweep
+    # over each diagonal in order, and only expand those matches that end beyond it.
+    diagonals = starts_a - starts_b
+    order = np.lexsort((starts_a, diagonals))
+
+    expanded_span_matches = []
+    diagonal = end_a = None
+    for start_a, match_end_a, match_diagonal in zip(starts_a[order].tolist(), ends_a[order].tolist(),
+                                                    diagonals[order].tolist()):
+        if match_diagonal == diagonal and match_end_a <= end_a:
             continue
+        diagonal = match_diagonal
+        start_b = start_a - diagonal
 
         # Expand left
-        start_a, start_b = _expand_side(span_a.start, span_b.start, -1)
+        length = _common_prefix_length(ids_a[start_a - 1::-1] if start_a else ids_a[:0],
+                                       ids_b[start_b - 1::-1] if start_b else ids_b[:0])
+        start_a, start_b = start_a - length, start_b - length
 
         # Expand right
-        end_a, end_b = _expand_side(span_a.end, span_b.end, 1)
+        end_a = max(match_end_a, start_a + 1)
+        end_a += _common_prefix_length(ids_a[end_a:], ids_b[end_a - diagonal:])
+        end_b = end_a - diagonal
 
-        new_span_a = Span(span_a.file, tokens_a[start_a].start, tokens_a[end_a].end)
-        new_span_b = Span(span_b.file, tokens_b[start_b].start, tokens_b[end_b].end)
+        expanded_span_matches.append((Span(file_a, tokens_a[start_a].start, tokens_a[end_a - 1].end),
+                                      Span(file_b, tokens_b[start_b].start, tokens_b[end_b - 1].end)))
 
-        span_tree_a.addi(new_span_a.start, new_span_a.end)
-        span_tree_b.addi(new_span_b.start, new_span_b.end)
+    return expanded_span_matches
 
-        # Add new spans
-        expanded_span_matches.add((new_span_a, new_span_b))
 
-    # print(expanded_span_matches)
-    return list(expanded_span_matches)
+def _common_prefix_length(ids_a, ids_b):
+    """Number of leading ids that ``ids_a`` and ``ids_b`` have in common."""
+    n = min(len(ids_a), len(ids_b))
+    mismatches = np.flatnonzero(ids_a[:n] != ids_b[:n])
+    return int(mismatches[0]) if len(mismatches) else n
 
 
 def _flatten_spans(spans):
@@ -273,62 +391,95 @@ def _group_span_matches(span_matches):
 
 
 def _transitive_closure(connections):
-    class Graph:
-        def __init__(self):
-            self.connections = collections.defaultdict(set)
-
-        def add(self, a, b):
-            self.connections[a].add(b)
-            self.connections[b].add(a)
-
-        def traverse(self, node, visited=None):
-            if visited is None:
-                visited = set()
-
-            visited.add(node)
-
-            for other_node in self.connections[node]:
-                if other_node not in visited:
-                    self.traverse(other_node, visited)
+    """
+    Partition everything in ``connections`` (pairs of hashable objects) into sets of
+    (transitively) connected objects, with an iterative union-find.
+    """
+    ids = {}
+    parents = []
+    sizes = []
 
-            return visited
+    def find(id):
+        # Halve the path to the root on the way
+        while parents[id] != id:
+            parents[id] = parents[parents[id]]
+            id = parents[id]
+        return id
 
-    graph = Graph()
     for a, b in connections:
-        graph.add(a, b)
-
-    trans_closure = []
-    nodes = graph.connections.keys()
-    while nodes:
-        node = next(iter(nodes))
-        reachable_nodes = graph.traverse(node)
-        nodes -= reachable_nodes
-        trans_closure.append(reachable_nodes)
-    return trans_closure
-
+        for node in (a, b):
+            if node not in ids:
+                ids[node] = len(parents)
+                parents.append(len(parents))
+                sizes.append(1)
+
+        root_a, root_b = find(ids[a]), find(ids[b])
+        if root_a == root_b:
+            continue
+        # Hang the smaller tree below the larger one
+        if sizes[root_a] < sizes[root_b]:
+            root_a, root_b = root_b, root_a
+        parents[root_b] = root_a
+        sizes[root_a] += sizes[root_b]
 
-def _is_span_subsumed(span, other_spans):
-    for other_span in other_spans:
-        if span.start >= other_span.start and span.end <= other_span.end:
-            return True
-    return False
+    trans_closure = collections.defaultdict(set)
+    for node, id in ids.items():
+        trans_closure[find(id)].add(node)
+    return list(trans_closure.values())
 
 
-def _is_group_subsumed(group, groups):
-    for other_group in groups:
-        if other_group == group or len(other_group.spans) < len(group.spans):
-            continue
-
+def _filter_subsumed_groups(groups):
+    """
+    Remove every group whose spans are each contained in a span (of the same file) of
+    one other group with at least as many spans.
+    """
+    # All spans of all groups per file, sorted by start, with the group of each
+    file_to_spans = collections.defaultdict(list)
+    for i, group in enumerate(groups):
         for span in group.spans:
-            if not _is_span_subsumed(span, filter(lambda other: span.file == other.file, other_group.spans)):
+            file_to_spans[span.file].append((span.start, span.end, i))
+
+    # The same per group and file, with the largest end so far at every span.
+    # Then whether a group contains a span is a binary search for the spans starting before it.
+    file_to_arrays = {}
+    group_file_to_spans = {}
+    for file, spans in file_to_spans.items():
+        spans.sort()
+        file_to_arrays[file] = tuple(np.array(column, dtype=np.int64) for column in zip(*spans))
+        for start, end, i in spans:
+            starts, max_ends = group_file_to_spans.setdefault((i, file), ([], []))
+            starts.append(start)
+            max_ends.append(max(end, max_ends[-1]) if max_ends else end)
+
+    def contains(i, span):
+        try:
+            starts, max_ends = group_file_to_spans[(i, span.file)]
+        except KeyError:
+            return False
+        n = bisect.bisect_right(starts, span.start)
+        return n > 0 and max_ends[n - 1] >= span.end
+
+    sizes = [len(group.spans) for group in groups]
+    filtered_groups = []
+    for i, group in enumerate(groups):
+        spans = iter(group.spans)
+
+        # Candidates are the groups with a span containing any one span of this group
+        span = next(spans)
+        starts, ends, group_ids = file_to_arrays[span.file]
+        n = np.searchsorted(starts, span.start, side="right")
+        candidates = {other for other in group_ids[:n][ends[:n] >= span.end].tolist()
+                      if other != i and sizes[other] >= sizes[i]}
+
+        # Of which only those containing all spans subsume this group
+        for span in spans:
+            if not candidates:
                 break
-        else:
-            return True
-    return False
+            candidates = {other for other in candidates if contains(other, span)}
 
-
-def _filter_subsumed_groups(groups):
-    return [g for g in groups if not _is_group_subsumed(g, groups)]
+        if not candidates:
+            filtered_groups.append(group)
+    return filtered_groups
 
 
 class _ProgressBar:
@@ -369,6 +520,13 @@ class _ProgressBar:
         except AttributeError:
             self._n += amount
 
+    def write(self, msg):
+        """Print a message without breaking up the bar, or to stderr if there is none."""
+        try:
+            self._bar.write(msg)
+        except AttributeError:
+            print(msg, file=sys.stderr)
+
     def close(self, leave=True):
         try:
             self._bar.close(leave)
@@ -441,9 +599,8 @@ class FauxExecutor:
         pass
 
     def map(self, fn, *iterables, **_kwargs):
-        for iterable in iterables:
-            for res in map(fn, iterable):
-                yield res
+        for res in map(fn, *iterables):
+            yield res
 
     def submit(self, fn, *args, **kwargs):
         try:
@@ -460,5 +617,51 @@ class FauxExecutor:
         return
 
 
+@contextlib.contextmanager
+def token_cache():
+    """
+    Cache the raw tokens of every file that is lexed for as long as the context lasts,
+    such that each file is lexed only once. Worker processes of ``Executor`` share it.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        File._token_cache = TokenCache(directory)
+        try:
+            yield File._token_cache
+        finally:
+            File._token_cache = None
+
+
+@contextlib.contextmanager
+def content_cache(max_size=256 * 1024 * 1024, mmap_size=None):
+    """
+    Cache the contents of every file that is read for as long as the context lasts, up to
+    ``max_size`` characters, memory mapping files of at least ``mmap_size`` bytes. Worker
+    processes of ``Executor`` start with a copy of the cache as it is when they start.
+    """
+    File._content_cache = ContentCache(max_size, mmap_size)
+    try:
+        yield File._content_cache
+    finally:
+        File._content_cache = None
+
+
+def _init_worker(token_cache, content_cache):
+    File._token_cache = token_cache
+    File._content_cache = content_cache
+
+
+class _ProcessPoolExecutor(concurrent.futures.ProcessPoolExecutor):
+    """
+    ProcessPoolExecutor whose workers share the token cache of the process starting them,
+    and, if forked, start with a copy of its content cache, such that they don't read files again.
+    """
+    def __init__(self, max_workers=None, mp_context=None, **kwargs):
+        # Forked workers inherit the content cache for free, others would each unpickle all of it
+        start_method = (mp_context or multiprocessing).get_start_method()
+        content_cache = File._content_cache if start_method == "fork" else None
+        super().__init__(max_workers, mp_context, initializer=_init_worker,
+                         initargs=(File._token_cache, content_cache), **kwargs)
+
+
 #: Executor used for concurrency
-Executor = concurrent.futures.ProcessPoolExecutor
+Executor = _ProcessPoolExecutor
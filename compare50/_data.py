@@ -1,12 +1,22 @@
 import abc
-from collections.abc import Mapping, Sequence
+import collections
+from collections.abc import Mapping
+import functools
+import hashlib
+import mmap
 import os
 import pathlib
+import pickle
+import posixpath
 import numbers
+import tarfile
+import tempfile
+import zipfile
 
 import attr
 import pygments
 import pygments.lexers
+import pygments.token
 
 
 __all__ = ["Pass", "Comparator", "File", "Submission",
@@ -65,6 +75,8 @@ class Comparator(metaclass=abc.ABCMeta):
         r"""
         Given a list of submissions, a list of archive submissions, and a set of distro
         files, return a list of :class:`compare50.Score`\ s for each submission pair.
+        This may be any sequence of scores instead; if it has an ``nlargest(n)`` method,
+        that is used to find the top ``n`` scores when ranking.
         """
         pass
 
@@ -73,7 +85,10 @@ class Comparator(metaclass=abc.ABCMeta):
         r"""
         Given a list of scores and a list of distro files, perform an in-depth
         comparison of each submission pair and return a corresponding list of
-        :class:`compare50.Comparison`\ s
+        :class:`compare50.Comparison`\ s. A comparator may also have an
+        ``iter_compare(scores, ignored_files, executor=None)`` method that returns an
+        iterator over the same comparisons, run on ``executor`` if given; that is used to
+        compare lazily.
         """
         pass
 
@@ -161,6 +176,10 @@ class File:
     Represents a single file from a submission.
     """
     _lexer_cache = {}
+    # TokenCache of the current run, if any
+    _token_cache = None
+    # ContentCache of the current run, if any
+    _content_cache = None
     _store = IdStore(key=lambda file: file.path)
 
     name = attr.ib(converter=pathlib.Path, cmp=False)
@@ -174,9 +193,42 @@ class File:
 
     def read(self, size=-1):
         """Open file, read ``size`` bytes from it, then close it."""
+        if File._content_cache is not None:
+            content = File._content_cache.read(self)
+            return content if size < 0 else content[:size]
+
+        if _archive_of(self.submission.path) is not None:
+            content = _decode(self.read_bytes())
+            return content if size < 0 else content[:size]
+
         with open(self.path) as f:
             return f.read(size)
 
+    def read_bytes(self):
+        """The contents of the file as bytes, straight from storage."""
+        archive = _archive_of(self.submission.path)
+        if archive is not None:
+            path, prefix = archive
+            # Tar archives are read a submission at a time, see _read_archive_member
+            names = [posixpath.join(prefix, file.name.as_posix()) for file in self.submission.files]
+            return _read_archive_member(path, posixpath.join(prefix, self.name.as_posix()), names)
+
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def digest(self):
+        """Digest of the contents of the file, files with the same contents have the same digest."""
+        if File._content_cache is not None:
+            return File._content_cache.digest(self)
+        return _digest(self.read_bytes())
+
+    def stat(self):
+        """``os.stat`` of the file, or of the zip or tar archive that it's in."""
+        archive = _archive_of(self.submission.path)
+        if archive is not None:
+            return archive[0].stat()
+        return self.path.stat()
+
     def tokens(self):
         """Returns the preprpocessed tokens of the file."""
         return list(self.submission.preprocessor(self.unprocessed_tokens()))
@@ -207,8 +259,14 @@ class File:
 
     def unprocessed_tokens(self):
         """Get the raw tokens of the file."""
+        lexer = self.lexer()
+        if File._token_cache is not None:
+            tokens = File._token_cache.get(self, lexer)
+            if tokens is not None:
+                return tokens
+
         text = self.read()
-        lexer_tokens = self.lexer().get_tokens_unprocessed(text)
+        lexer_tokens = lexer.get_tokens_unprocessed(text)
         tokens = []
         prevToken = None
         for token in lexer_tokens:
@@ -221,9 +279,220 @@ class File:
         if prevToken:
             tokens.append(Token(start=prevToken[0], end=len(text),
                                 type=prevToken[1], val=prevToken[2]))
+
+        if File._token_cache is not None:
+            File._token_cache.put(self, lexer, tokens)
         return tokens
 
 
+@attr.s(slots=True)
+class TokenCache:
+    """
+    :ivar directory: the directory in which the tokens are kept
+
+    Cache of the raw tokens of files, by file and lexer, such that every file is lexed
+    only once per run. Kept on disk so that worker processes can share it. Every lookup
+    returns new Tokens, as preprocessors are free to modify them.
+    """
+    directory = attr.ib(converter=pathlib.Path)
+
+    def get(self, file, lexer):
+        """The raw tokens of ``file`` as lexed by ``lexer``, or None if these are not cached."""
+        try:
+            with open(self._path(file, lexer), "rb") as f:
+                rows = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        return [Token(start=start, end=end, type=pygments.token.string_to_tokentype(type), val=val)
+                for start, end, type, val in rows]
+
+    def put(self, file, lexer, tokens):
+        """Cache the raw tokens of ``file`` as lexed by ``lexer``."""
+        # Token types do not survive pickle as themselves, so keep them by name
+        rows = [(tok.start, tok.end, ".".join(tok.type), tok.val) for tok in tokens]
+        with tempfile.NamedTemporaryFile(dir=self.directory, delete=False) as f:
+            pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, self._path(file, lexer))
+
+    def _path(self, file, lexer):
+        key = f"{file.path}\0{type(lexer).__module__}.{type(lexer).__qualname__}"
+        return self.directory / hashlib.blake2b(key.encode("utf-8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+@attr.s(slots=True)
+class ContentCache:
+    """
+    :ivar max_size: the maximum number of characters of contents to keep
+    :ivar mmap_size: files of at least this many bytes are memory mapped rather than \
+            kept, if not None
+
+    Cache of the contents of files, such that every file is read from storage only once
+    per run. Once more than ``max_size`` characters are kept, the least recently read files
+    are let go of. Memory mapped files don't count towards ``max_size`` until they are
+    read, the operating system keeps their pages around instead. Once read, their text is
+    kept like that of any other file. The digests of all contents are kept.
+    """
+    max_size = attr.ib(default=256 * 1024 * 1024)
+    mmap_size = attr.ib(default=None)
+    _contents = attr.ib(factory=collections.OrderedDict, init=False, repr=False)
+    _digests = attr.ib(factory=dict, init=False, repr=False)
+    _size = attr.ib(default=0, init=False, repr=False)
+
+    def read(self, file):
+        """The contents of ``file``, decoded as ``open(file.path).read()`` would."""
+        try:
+            content = self._contents[file.path]
+        except KeyError:
+            content = self._load(file)
+        else:
+            self._contents.move_to_end(file.path)
+
+        if isinstance(content, mmap.mmap):
+            # Decode a memory mapped file just once, from then on keep its text like any other
+            text = _decode(content)
+            if len(text) <= self.max_size:
+                self._keep(file.path, text)
+                content.close()
+            return text
+        return content
+
+    def digest(self, file):
+        """Digest of the contents of ``file``."""
+        try:
+            return self._digests[file.path]
+        except KeyError:
+            self._load(file)
+            return self._digests[file.path]
+
+    def add(self, path, content, digest):
+        """Cache ``content``, the decoded text of the file at ``path``, and its ``digest``."""
+        self._digests[path] = digest
+        self._keep(path, content)
+
+    def __reduce__(self):
+        # Memory maps can't be pickled, a process unpickling the cache maps those files anew
+        contents = [(path, content) for path, content in self._contents.items()
+                    if not isinstance(content, mmap.mmap)]
+        return self._unpickle, (self.max_size, self.mmap_size, contents, self._digests)
+
+    @classmethod
+    def _unpickle(cls, max_size, mmap_size, contents, digests):
+        cache = cls(max_size, mmap_size)
+        cache._contents.update(contents)
+        cache._digests.update(digests)
+        cache._size = sum(len(content) for _, content in contents)
+        return cache
+
+    def _load(self, file):
+        if self.mmap_size is not None and _archive_of(file.submission.path) is None:
+            with open(file.path, "rb") as f:
+                # Empty files can't be memory mapped
+                if os.fstat(f.fileno()).st_size >= max(self.mmap_size, 1):
+                    content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    self._digests[file.path] = _digest(content)
+                    self._contents[file.path] = content
+                    return content
+
+        data = file.read_bytes()
+        self._digests[file.path] = _digest(data)
+        return self._keep(file.path, _decode(data))
+
+    def _keep(self, path, content):
+        replaced = self._contents.pop(path, None)
+        if replaced is not None and not isinstance(replaced, mmap.mmap):
+            self._size -= len(replaced)
+
+        if len(content) <= self.max_size:
+            self._contents[path] = content
+            self._size += len(content)
+            while self._size > self.max_size:
+                _, evicted = self._contents.popitem(last=False)
+                if isinstance(evicted, mmap.mmap):
+                    evicted.close()
+                else:
+                    self._size -= len(evicted)
+        return content
+
+
+def _decode(data):
+    """
+    Decode ``data``, bytes or any buffer, as utf8 with the newline translation of reading
+    the file in text mode. Raises ``UnicodeDecodeError`` if ``data`` is not valid utf8.
+    """
+    return str(data, "utf8").replace("\r\n", "\n").replace("\r", "\n")
+
+
+def _digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+#: Suffixes of the zip and tar archives that submissions can be read from directly
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def _is_archive_file(path):
+    """Whether ``path`` is a zip or tar archive, whose members make up a submission."""
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES) and os.path.isfile(path)
+
+
+def _iter_archive(path):
+    """
+    Iterate over the regular files in the zip or tar archive at ``path`` in a single pass,
+    as ``(name, size, read)``. ``read()`` returns the file's contents, but only while the
+    iteration is at that file. Members that would end up outside of the archive are skipped.
+    """
+    def is_safe(name):
+        name = pathlib.PurePosixPath(name)
+        return not name.is_absolute() and ".." not in name.parts
+
+    if str(path).lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and is_safe(info.filename):
+                    yield info.filename, info.file_size, functools.partial(archive.read, info)
+    else:
+        # Stream, such that compressed archives are decompressed just once
+        with tarfile.open(path, mode="r|*") as archive:
+            for member in archive:
+                if member.isreg() and is_safe(member.name):
+                    yield member.name, member.size, archive.extractfile(member).read
+
+
+def _archive_of(path):
+    """
+    If ``path`` is a zip or tar archive, or a directory within one, the path of that archive
+    and the name of ``path`` within it (``""`` for the archive itself), ``None`` otherwise.
+    """
+    path = pathlib.Path(path)
+    for archive in (path, *path.parents):
+        if _is_archive_file(archive):
+            return archive, "/".join(path.relative_to(archive).parts)
+    return None
+
+
+def _read_archive_member(path, name, names=()):
+    """
+    The contents of member ``name`` of the zip or tar archive at ``path``.
+    Members of a tar archive are read alongside the other members ``names``, of the same submission.
+    """
+    if str(path).lower().endswith(".zip"):
+        with zipfile.ZipFile(path) as archive:
+            return archive.read(name)
+    stat = os.stat(path)
+    return _tar_members(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, frozenset(names) | {name})[name]
+
+
+@functools.lru_cache(maxsize=4)
+def _tar_members(path, mtime, size, names):
+    """
+    The contents of the members ``names`` of the tar archive at ``path``, read in a single pass.
+    Tar archives have no index to seek by, and compressed ones can only be decompressed
+    from the start, so reading a submission's members one by one would be quadratic.
+    ``mtime`` and ``size`` tell a changed archive apart.
+    """
+    return {name: read() for name, _, read in _iter_archive(path) if name in names}
+
+
 @attr.s(slots=True)
 class Preprocessor:
     """Hack to ensure that composed preprocessor is serializable by Pickle."""
@@ -268,7 +537,10 @@ class Comparison:
             the first element of each pair is from ``sub_a`` and the second is from \
             ``sub_b``.
     :ivar ignored_spans: a list of :class:`compare50.Span`\ s which were ignored \
-            (e.g. because they matched distro files)
+            (e.g. because they matched distro files). Or, such that these need not be \
+            divided per file and flattened for every comparison, a mapping from each \
+            file of both submissions to its ignored spans, sorted and without overlap, \
+            including any spans that the preprocessor removed.
 
     Represents an in-depth comparison of two submissions.
     """
@@ -377,50 +649,3 @@ class Token:
     def __eq__(self, other):
         # Note that there is no sanity checking. Sacrificed for performance.
         return self.val == other.val and self.type == other.type
-
-
-class BisectList(Sequence):
-    """
-    A sorted list allowing for easy binary seaching. This exists because Python's
-    bisect does not allow you to compare objects via a key function.
-    """
-    def __init__(self, iter=None, key=lambda x: x):
-        self.contents = sorted(iter, key=key) if iter is not None else []
-        self.key = key
-
-    @classmethod
-    def from_sorted(cls, iter=None, key=lambda x: x):
-        s_list = BisectList(key=key)
-        if iter is not None:
-            s_list.contents = list(iter)
-        return s_list
-
-    def __len__(self):
-        return len(self.contents)
-
-    def __getitem__(self, idx):
-        return self.contents[idx]
-
-    def bisect_key_right(self, x):
-        lo = 0
-        hi = len(self.contents)
-
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if x < self.key(self.contents[mid]):
-                hi = mid
-            else:
-                lo = mid + 1
-        return lo
-
-    def bisect_key_left(self, x):
-        lo = 0
-        hi = len(self.contents)
-
-        while lo < hi:
-            mid = (lo + hi) // 2
-            if self.key(self.contents[mid]) < x:
-                lo = mid + 1
-            else:
-                hi = mid
-        return lo
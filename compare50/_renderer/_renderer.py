@@ -81,53 +81,66 @@ class HTMLSubmission:
             return 0
 
 
-def render(pass_to_results, dest):
+def render(pass_to_results, dest, executor=None):
+    if executor is None:
+        with _api.Executor() as executor:
+            return render(pass_to_results, dest, executor)
+
     bar = _api.get_progress_bar()
     dest = pathlib.Path(dest)
 
-    sub_pair_to_results = collections.defaultdict(list)
-    for results in pass_to_results.values():
-        for result in results:
-            sub_pair_to_results[(result.sub_a, result.sub_b)].append(result)
+    # Results of every pass for the same submission pair, in order of the first pass' score.
+    # Results are read one pair at a time, such that lazily computed results can be let go of
+    # once rendered.
+    results_per_sub_pair = zip(*pass_to_results.values())
+    max_id = min(len(results) for results in pass_to_results.values())
 
-    bar.reset(total=len(sub_pair_to_results) + 1)
-    # Sort by score
-    results_per_sub_pair = sorted(sub_pair_to_results.values(),
-                                  key=lambda res: res[0].score, reverse=True)
+    bar.reset(total=max_id + 1)
 
     common_css = [read_file(STATIC / f) for f in  ("bootstrap.min.css", "fonts.css")]
     match_css = common_css + [read_file(STATIC / "match.css")]
     match_js = [read_file(STATIC / f) for f in ("split.min.js", "match.js")]
-    # Render all matches
-    with _api.Executor() as executor:
-        # Load static files
-        max_id = len(results_per_sub_pair)
-        for id, html in executor.map(_RenderTask(dest, max_id, match_js, match_css), enumerate(results_per_sub_pair, 1)):
-            with open(dest / f"match_{id}.html", "w") as f:
-                f.write(html)
-            bar.update()
 
+    # Only keep the scores of the ranking pass around to create the index
+    ranking_scores = []
+
+    # Render all matches, with only a few at a time in flight
+    render_task = _RenderTask(dest, max_id, match_js, match_css)
+    max_in_flight = 2 * (os.cpu_count() or 1)
+    in_flight = collections.deque()
+
+    def write(future):
+        id, html = future.result()
+        with open(dest / f"match_{id}.html", "w") as f:
+            f.write(html)
+        bar.update()
+
+    for id, results in enumerate(results_per_sub_pair, 1):
+        ranking_scores.append(results[0].score)
+        in_flight.append(executor.submit(render_task, (id, results)))
+        if len(in_flight) > max_in_flight:
+            write(in_flight.popleft())
+
+    while in_flight:
+        write(in_flight.popleft())
 
     # Create index
     with open(TEMPLATES / "index.html") as f:
         index_template = jinja2.Template(
             f.read(), autoescape=jinja2.select_autoescape(enabled_extensions=("html",)))
 
-    ranking_pass, ranking_results = next(iter(pass_to_results.items()))
-
-
     try:
-        max_score = max((result.score.score for result in ranking_results))
+        max_score = max((score.score for score in ranking_scores))
     except ValueError:
         max_score = 0
 
     # Generate cluster data
     subs = set()
     graph_info = {"nodes": [], "links": [], "data": {}}
-    for i, result in enumerate(ranking_results):
-        graph_info["links"].append({"index":i, "source": str(result.sub_a.path), "target": str(result.sub_b.path), "value": 10 * result.score.score/max_score})
-        subs.add(result.sub_a)
-        subs.add(result.sub_b)
+    for i, score in enumerate(ranking_scores):
+        graph_info["links"].append({"index":i, "source": str(score.sub_a.path), "target": str(score.sub_b.path), "value": 10 * score.score/max_score})
+        subs.add(score.sub_a)
+        subs.add(score.sub_b)
 
     for sub in subs:
         graph_info["nodes"].append({"id": str(sub.path)})
@@ -314,8 +327,7 @@ class _FragmentSlicer:
         self._slicing_marks.discard(0)
 
         # Get file content
-        with open(file.path) as f:
-            content = f.read()
+        content = file.read()
 
         # If there are no slicing marks, return entire file in one fragment
         if not self._slicing_marks:
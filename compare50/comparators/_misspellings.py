@@ -7,7 +7,7 @@ import re
 import attr
 from pygments.token import Comment
 
-from .. import Comparator, Span, Comparison, Score
+from .. import _api, Comparator, Span, Comparison, Score
 
 
 class Misspellings(Comparator):
@@ -52,20 +52,23 @@ class Misspellings(Comparator):
         comparisons = []
         for score in scores:
             span_matches = []
-            ignored_spans = set()
             for file_a, file_b in itertools.product(score.sub_a.files, score.sub_b.files):
                 results_a, results_b = spellcheck_results[file_a], spellcheck_results[file_b]
-
-                ignored_spans.update(results_a.correct, results_b.correct)
                 span_matches.extend(results_a.match_misspellings(results_b))
 
+            ignored_spans = {file: spellcheck_results[file].ignored
+                             for file in itertools.chain(score.sub_a.files, score.sub_b.files)}
             comparisons.append(Comparison(score.sub_a, score.sub_b,
-                                          span_matches, list(ignored_spans)))
+                                          span_matches, ignored_spans))
         return comparisons
 
     def _spellcheck(self, file, ignored_words):
+        # Only the positions of the raw tokens are needed, so the preprocessor may change them
+        raw_tokens = file.unprocessed_tokens()
+        tokens = list(file.submission.preprocessor(raw_tokens))
+
         word_to_spans = collections.defaultdict(list)
-        for token in file.tokens():
+        for token in tokens:
             word_to_spans[token.val].append(Span(file, token.start, token.end))
 
         result = SpellcheckResult()
@@ -76,6 +79,7 @@ class Misspellings(Comparator):
             else:
                 result.misspelled[word] = spans
 
+        result.ignored = _api._flatten_spans(result.correct + _api.missing_spans(file, raw_tokens, tokens))
         return result
 
 
@@ -87,6 +91,10 @@ class SpellcheckResult:
     # Dict mapping misspelled words to spans
     misspelled = attr.ib(factory=dict)
 
+    # Sorted list of spans without overlap of correctly spelled words, and of anything
+    # the preprocessor removed
+    ignored = attr.ib(factory=list)
+
     def match_misspellings(self, other):
         """Find all misspellings that self and other have in common and yield an iterable over all pairs of identical misspellings"""
         # Iterate over all keys of smaller dictionary for minor efficiency gain
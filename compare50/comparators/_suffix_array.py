@@ -0,0 +1,87 @@
+"""Maximal common substrings of sequences of integer ids, found by way of a suffix array."""
+import numpy as np
+
+
+def suffix_array(ids):
+    """
+    Suffix array of ``ids`` by prefix doubling. Returns the suffix array, and for every
+    ``i`` the rank of the first ``2**i`` ids of each suffix; suffixes that share their
+    first ``2**i`` ids have the same rank at level ``i``.
+    """
+    n = len(ids)
+    rank = np.unique(ids, return_inverse=True)[1].astype(np.int64).reshape(n)
+    ranks = [rank]
+    width = 1
+    while width < n and rank.max() < n - 1:
+        # Rank of the ``width`` ids following the first ``width``, -1 past the end
+        next_rank = np.full(n, -1, dtype=np.int64)
+        next_rank[:-width] = rank[width:]
+
+        order = np.lexsort((next_rank, rank))
+        is_new = np.ones(n, dtype=bool)
+        is_new[1:] = (rank[order][1:] != rank[order][:-1]) | (next_rank[order][1:] != next_rank[order][:-1])
+        rank = np.empty(n, dtype=np.int64)
+        rank[order] = np.cumsum(is_new) - 1
+
+        ranks.append(rank)
+        width *= 2
+
+    return np.argsort(rank, kind="stable"), ranks
+
+
+def common_prefix_lengths(ranks, suffixes, other_suffixes):
+    """
+    Length of the longest common prefix of each suffix in ``suffixes`` and the one at the
+    same position in ``other_suffixes``, given the ``ranks`` from ``suffix_array``.
+    """
+    n = len(ranks[0])
+    lengths = np.zeros(len(suffixes), dtype=np.int64)
+    for level in reversed(range(len(ranks))):
+        starts, other_starts = suffixes + lengths, other_suffixes + lengths
+        is_same = (starts < n) & (other_starts < n)
+        is_same[is_same] = ranks[level][starts[is_same]] == ranks[level][other_starts[is_same]]
+        lengths += is_same.astype(np.int64) << level
+    return lengths
+
+
+def maximal_matches(ids, n, min_length):
+    """
+    Find all maximal common substrings of at least ``min_length`` ids between
+    ``ids[:n]`` and ``ids[n:]``. Returns the start of each in ``ids[:n]``, its start in
+    ``ids[n:]`` (as a position in ``ids``), and its length, sorted by start.
+    Separate sequences may be concatenated into ``ids``, as long as each is followed by
+    an id that occurs nowhere else; no substring can extend over such an id.
+    """
+    empty = np.empty(0, dtype=np.int64)
+    if not n or n == len(ids) or min_length < 1:
+        return empty, empty, empty
+
+    sa, ranks = suffix_array(ids)
+
+    # Suffixes sharing their first min_length ids are consecutive in the suffix array,
+    # so split it into blocks of such suffixes
+    lengths = np.zeros(len(sa), dtype=np.int64)
+    lengths[1:] = common_prefix_lengths(ranks, sa[:-1], sa[1:])
+    blocks = np.cumsum(lengths < min_length) - 1
+    n_blocks = blocks[-1] + 1
+
+    # Every suffix from the first sequence, paired with every one from the second in the same block
+    is_first = sa < n
+    offsets = np.searchsorted(blocks[is_first], np.arange(n_blocks + 1))
+    other_offsets = np.searchsorted(blocks[~is_first], np.arange(n_blocks + 1))
+    sizes, other_sizes = np.diff(offsets), np.diff(other_offsets)
+    n_pairs = sizes * other_sizes
+
+    pair_blocks = np.repeat(np.arange(n_blocks), n_pairs)
+    positions = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    starts = sa[is_first][offsets[pair_blocks] + positions // other_sizes[pair_blocks]]
+    other_starts = sa[~is_first][other_offsets[pair_blocks] + positions % other_sizes[pair_blocks]]
+
+    # Keep only those pairs that cannot be extended to the left, then extend them to the right
+    is_maximal = starts == 0
+    is_maximal[~is_maximal] = ids[starts[~is_maximal] - 1] != ids[other_starts[~is_maximal] - 1]
+    starts, other_starts = starts[is_maximal], other_starts[is_maximal]
+    lengths = common_prefix_lengths(ranks, starts, other_starts)
+
+    order = np.lexsort((other_starts, starts))
+    return starts[order], other_starts[order], lengths[order]
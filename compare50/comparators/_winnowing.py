@@ -1,14 +1,26 @@
 import abc
 import collections
+import collections.abc
+import copy
+import functools
+import hashlib
 import itertools
+import json
+import marshal
 import math
+import os
+import pathlib
+import shutil
 import sys
+import tempfile
 
 import attr
 import numpy as np
+import pygments
 
 
 from .. import _api, Comparison, Comparator, Submission, Span, Score
+from . import _suffix_array
 
 
 class Winnowing(Comparator):
@@ -18,62 +30,323 @@ class Winnowing(Comparator):
     :type t: int
     :parma k: the noise threshold; any matching sequence of tokens shorter than this will be ignored
     :type k: int
+    :param engine: how fingerprints are computed, either ``"python"`` or ``"numpy"`` \
+                   (vectorized, faster on large files)
+    :type engine: str
+    :param archive_cache: directory in which the fingerprints of archive submissions are \
+                          kept between runs, or ``None`` to fingerprint them every run
+    :type archive_cache: str or pathlib.Path
+    :param max_df: when scoring, ignore fingerprints that occur in more than this number \
+                   (int), or this fraction (float), of all submissions. ``None`` for no limit.
+    :type max_df: int or float
+    :param incremental: directory in which the scoring state of a run is kept, such that a \
+                        later run over the same submissions plus some new ones only scores \
+                        what is new. ``None`` to always score everything.
+    :type incremental: str or pathlib.Path
+    :param match_engine: how the matching spans of two files are found, either \
+                         ``"fingerprints"`` (every matching k-gram, expanded as far as \
+                         possible) or ``"suffix_array"`` (the maximal matches of at least k \
+                         tokens directly, faster on heavily copied files)
+    :type match_engine: str
     """
 
-    __slots__ = ["k", "t"]
+    __slots__ = ["k", "t", "engine", "archive_cache", "max_df", "incremental", "match_engine"]
 
-    def __init__(self, k, t):
+    def __init__(self, k, t, engine="python", archive_cache=None, max_df=None, incremental=None,
+                 match_engine="fingerprints"):
+        if engine not in ENGINES:
+            raise ValueError(f"unknown engine {engine!r}, expected one of {ENGINES}")
+        if match_engine not in MATCH_ENGINES:
+            raise ValueError(f"unknown match engine {match_engine!r}, expected one of {MATCH_ENGINES}")
         self.k = k
         self.t = t
+        self.engine = engine
+        self.archive_cache = archive_cache
+        self.max_df = max_df
+        self.incremental = incremental
+        self.match_engine = match_engine
 
     def score(self, submissions, archive_submissions, ignored_files):
-        """Number of matching k-grams."""
-        def files(subs):
-            return [f for sub in subs for f in sub]
+        """
+        Number of matching k-grams, each weighted by ``1 + log(N / (1 + df))``, where N is
+        the number of submissions and df the number of files the k-gram occurs in.
+        """
+        # Submissions are numbered by their position in this list: regular submissions
+        # first, archive submissions last, both sorted by path. Then the pairs (a, b) with
+        # a < b and a regular are exactly the pairs to score, and ties rank the same every run.
+        submissions = sorted(submissions, key=lambda sub: str(sub.path))
+        archive_submissions = sorted(archive_submissions, key=lambda sub: str(sub.path))
+        all_submissions = submissions + archive_submissions
 
-        submission_index = ScoreIndex(self.k, self.t)
-        archive_index = ScoreIndex(self.k, self.t)
-        ignored_index = ScoreIndex(self.k, self.t)
+        bar = _api.get_progress_bar()
+        bar.reset(total=math.ceil((sum(len(sub.files) for sub in all_submissions) + len(ignored_files)) / 0.9))
 
-        submission_files = files(submissions)
-        archive_files = files(archive_submissions)
+        header = state = None
+        if self.incremental is not None:
+            header = self._state_header(all_submissions, ignored_files)
+        if header is not None:
+            state = _ScoreState.load(pathlib.Path(self.incremental) / f"k{self.k}-t{self.t}", header,
+                                     ScoreIndex(self.k, self.t, self.engine), submissions, archive_submissions)
 
-        bar = _api.get_progress_bar()
-        bar.reset(total=math.ceil((len(submission_files) + len(archive_files) + len(ignored_files)) / 0.9))
-        frequency_map = collections.Counter()
         with _api.Executor() as executor:
-            
-            # Subs and archive subs
-            for index, files in ((submission_index, submission_files), (archive_index, archive_files)):
-                for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), files):
-                    for hash_ in idx.keys():
-                        frequency_map[hash_] += 1
-                    index.include_all(idx)
-                    bar.update()
-            
-            # Ignored files
-            for idx in executor.map(self._index_file(ScoreIndex, (self.k, self.t)), ignored_files):
-                ignored_index.include_all(idx)
-                bar.update()
+            if state is None:
+                state = self._score_all(submissions, archive_submissions, ignored_files, executor)
+            else:
+                state = self._score_new(state, submissions, archive_submissions, executor)
+
+        if header is not None:
+            state.save(pathlib.Path(self.incremental) / f"k{self.k}-t{self.t}", header, all_submissions)
+
+        N = len(all_submissions)
+        return state.pair_scores.nonzero(base=_to_fixed_point(1 + np.log(N)), submissions=all_submissions)
+
+    def _score_all(self, submissions, archive_submissions, ignored_files, executor):
+        """Fingerprint and score all submissions. Returns the resulting ``_ScoreState``."""
+        N = len(submissions) + len(archive_submissions)
+
+        # Subs
+        file_hashes = [np.empty(0, dtype=np.uint64)]
+        submission_index = self._index_files([f for sub in submissions for f in sub], executor,
+                                             {sub.id: i for i, sub in enumerate(submissions)}, file_hashes)
+
+        # Archive subs, from the cache if it is still valid
+        archive_index, archive_frequencies = self._index_archive(archive_submissions, executor)
+
+        # Ignored files
+        ignored_index = self._index_files(ignored_files, executor)
 
         submission_index.ignore_all(ignored_index)
         archive_index.ignore_all(ignored_index)
 
-        # Add submissions to archive (the Index we're going to compare against)
-        archive_index.include_all(submission_index)
+        # Add archive and submissions to the Index we're going to compare against. The archive's
+        # postings are positions in the archive, which come after the submissions
+        index = ScoreIndex(self.k, self.t, self.engine)
+        index.include_all(archive_index, offset=len(submissions)).include_all(submission_index)
 
-        N = len(submissions) + len(archive_submissions)
-        return submission_index.compare(archive_index, score=lambda h: 1 + math.log(N / (1 + frequency_map[h])))
+        # Number of files each hash occurs in
+        frequencies = _frequencies(np.unique(np.concatenate(file_hashes), return_counts=True), archive_frequencies)
+
+        state = _ScoreState(index=index, frequencies=frequencies, ignored_hashes=ignored_index.keys(),
+                            pair_scores=_PairScores(N), n_submissions=len(submissions), n_archives=len(archive_submissions))
+        submission_index.score_pairs(self._drop_frequent(index, N), state.pair_scores, executor,
+                                     weight=self._weight(frequencies))
+        return state
+
+    def _score_new(self, state, submissions, archive_submissions, executor):
+        """
+        Fingerprint only the submissions that are not in ``state`` yet, a ``_ScoreState``
+        from an earlier run over a subset of these submissions. Then update the scores of
+        the pairs in ``state`` for the new document frequencies, and score all new pairs.
+        """
+        all_submissions = submissions + archive_submissions
+        N = len(all_submissions)
+        N_old = state.n_submissions + state.n_archives
+        positions = {sub.id: i for i, sub in enumerate(all_submissions)}
+
+        # Fingerprint the new submissions
+        file_hashes = [np.empty(0, dtype=np.uint64)]
+        is_new = np.ones(N, dtype=bool)
+        is_new[state.positions] = False
+        new_index = self._index_files([f for i in np.flatnonzero(is_new) for f in all_submissions[i]], executor,
+                                      positions, file_hashes)
+        new_index._select(~np.isin(new_index.keys(), state.ignored_hashes, assume_unique=True))
+
+        old_index = state.index
+        index = ScoreIndex(self.k, self.t, self.engine).include_all(old_index).include_all(new_index)
+        frequencies = _frequencies(state.frequencies, np.unique(np.concatenate(file_hashes), return_counts=True))
+
+        # The new submissions change the weights of the hashes they contain, and which hashes
+        # are too frequent to score. Correct the scores of existing pairs for those hashes.
+        old_hashes, hashes = old_index.keys(), index.keys()
+        n_postings_old = np.diff(old_index._offsets)
+        n_postings = np.diff(index._offsets)[np.searchsorted(hashes, old_hashes)]
+        is_kept_old = n_postings_old <= self._max_postings(N_old)
+        is_kept = n_postings <= self._max_postings(N)
+
+        counts = is_kept.astype(np.int64) - is_kept_old
+        weights = is_kept * self._weight(frequencies)(old_hashes) \
+                  - is_kept_old * self._weight(state.frequencies)(old_hashes)
+        is_changed = np.repeat((counts != 0) | (weights != 0), n_postings_old)
+        is_regular = old_index._postings[:, 0] < len(submissions)
+        old_index._subset(is_changed & is_regular).score_pairs(old_index._subset(is_changed), state.pair_scores, executor,
+            weight=lambda hashes: weights[np.searchsorted(old_hashes, hashes)],
+            count=lambda hashes: counts[np.searchsorted(old_hashes, hashes)])
+
+        # Score all pairs with a new submission, the new one first, then the old one first
+        kept_index = self._drop_frequent(index, N)
+        new_index._subset(new_index._postings[:, 0] < len(submissions)).score_pairs(
+            kept_index, state.pair_scores, executor, weight=self._weight(frequencies))
+        old_index._subset(is_regular).score_pairs(
+            kept_index._subset(is_new[kept_index._postings[:, 0]]), state.pair_scores, executor,
+            weight=self._weight(frequencies))
+
+        return _ScoreState(index=index, frequencies=frequencies, ignored_hashes=state.ignored_hashes,
+                           pair_scores=state.pair_scores, n_submissions=len(submissions),
+                           n_archives=len(archive_submissions))
+
+    def _max_postings(self, N):
+        """Number of submissions a hash may occur in to be scored."""
+        if self.max_df is None:
+            return N
+        return math.floor(self.max_df * N) if isinstance(self.max_df, float) else self.max_df
+
+    def _drop_frequent(self, index, N):
+        """
+        A copy of ``index`` without the fingerprints that (nearly) every submission shares,
+        these cost a lot to score and say very little.
+        """
+        index = index._subset()
+        n_dropped = index.drop_frequent(self._max_postings(N))
+        if n_dropped:
+            _api.get_progress_bar().write(f"Ignoring {n_dropped} fingerprint{'s' if n_dropped > 1 else ''} "
+                                          f"found in more than {self._max_postings(N)} submissions")
+        return index
+
+    @staticmethod
+    def _weight(frequencies):
+        """
+        The (fixed point) weight of hashes, given the number of files they occur in. Scores
+        are ``1 + log(N)`` per common hash, plus the weights: ``-log(1 + df)``.
+        """
+        frequency_hashes, frequencies = frequencies
+        return lambda hashes: -_to_fixed_point(np.log(1 + frequencies[np.searchsorted(frequency_hashes, hashes)]))
+
+    def _index_files(self, files, executor, positions=None, file_hashes=None):
+        """
+        Fingerprint ``files`` in parallel and build a ScoreIndex of them all at once, with
+        ``positions[sub.id]`` as posting for submission ``sub``. The unique hashes of every
+        file are appended to ``file_hashes``.
+        """
+        bar = _api.get_progress_bar()
+        files = list(files)
+        chunksize = max(1, min(64, len(files) // (4 * (os.cpu_count() or 1))))
+
+        # Files with the same contents, lexer and preprocessor have the same fingerprints,
+        # such as untouched starter code, so fingerprint only one of each
+        keys = _file_keys(files, executor, chunksize)
+        unique_files = dict(zip(keys, files))
+        n_copies = collections.Counter(keys)
+
+        hashes_per_key = {}
+        hashes_per_file = executor.map(self._hash_file(ScoreIndex, (self.k, self.t, self.engine)),
+                                       unique_files.values(), chunksize=chunksize)
+        for key, hashes in zip(unique_files, hashes_per_file):
+            hashes_per_key[key] = hashes
+            bar.update(n_copies[key])
+
+        index = ScoreIndex(self.k, self.t, self.engine)
+        for file, key in zip(files, keys):
+            hashes = hashes_per_key[key]
+            position = positions[file.submission.id] if positions is not None else 0
+            index.include_fingerprints(hashes, np.full((len(hashes), 1), position, dtype=np.int64))
+            if file_hashes is not None:
+                file_hashes.append(hashes)
+        return index
+
+    def _index_archive(self, archive_submissions, executor):
+        """
+        Index all archive submissions, with ``i`` as posting for the ith. Returns the
+        index and a pair of arrays with every hash and the number of archive files it occurs in.
+        If ``archive_cache`` is set, the index is memory mapped from there, and (re)built and
+        stored if it is missing or stale.
+        """
+        bar = _api.get_progress_bar()
+        archive_files = [f for sub in archive_submissions for f in sub]
+
+        header = None
+        if self.archive_cache is not None:
+            header = self._archive_header(archive_submissions)
+        if header is not None:
+            archive_index = ScoreIndex(self.k, self.t, self.engine)
+            cached = _load_arrays(pathlib.Path(self.archive_cache) / f"k{self.k}-t{self.t}", header,
+                                  archive_index, ("frequency_hashes", "frequencies"))
+            if cached is not None:
+                bar.update(len(archive_files))
+                return archive_index, (cached["frequency_hashes"], cached["frequencies"])
+
+        file_hashes = [np.empty(0, dtype=np.uint64)]
+        archive_index = self._index_files(archive_files, executor,
+                                          {sub.id: i for i, sub in enumerate(archive_submissions)},
+                                          file_hashes)
+        frequency_hashes, frequencies = np.unique(np.concatenate(file_hashes), return_counts=True)
+
+        if header is not None:
+            _save_arrays(pathlib.Path(self.archive_cache) / f"k{self.k}-t{self.t}", header, archive_index,
+                         {"frequency_hashes": frequency_hashes, "frequencies": frequencies})
+
+        return archive_index, (frequency_hashes, frequencies)
+
+    def _archive_header(self, archive_submissions):
+        """
+        Everything the cached archive index depends on: the comparator's parameters, the
+        preprocessors, the tokenizer and the archive files themselves. Returns ``None`` if
+        the archive can't be cached, because its submissions are preprocessed differently.
+        """
+        preprocessors = {_preprocessor_key(sub.preprocessor) for sub in archive_submissions}
+        if len(preprocessors) != 1 or None in preprocessors:
+            return None
+
+        # Any change to the files in the archive invalidates the cache
+        manifest = hashlib.blake2b()
+        for sub in archive_submissions:
+            manifest.update(_submission_digest(sub).encode())
+
+        return {
+            "version": _ARCHIVE_CACHE_VERSION,
+            "k": self.k,
+            "t": self.t,
+            "preprocessors": preprocessors.pop(),
+            "pygments": pygments.__version__,
+            "manifest": manifest.hexdigest()
+        }
+
+    def _state_header(self, submissions, ignored_files):
+        """
+        Everything the scoring state depends on, other than the submissions. Returns ``None``
+        if there's no state to keep, because submissions are preprocessed differently.
+        """
+        preprocessors = {_preprocessor_key(sub.preprocessor) for sub in submissions}
+        if len(preprocessors) != 1 or None in preprocessors:
+            return None
+
+        distro = hashlib.blake2b()
+        for file in sorted(ignored_files, key=lambda file: str(file.path)):
+            stat = file.stat()
+            distro.update(json.dumps([str(file.path), stat.st_size, stat.st_mtime_ns]).encode())
+
+        return {
+            "version": _ARCHIVE_CACHE_VERSION,
+            "k": self.k,
+            "t": self.t,
+            "max_df": self.max_df,
+            "preprocessors": preprocessors.pop(),
+            "pygments": pygments.__version__,
+            "distro": distro.hexdigest()
+        }
 
     def compare(self, scores, ignored_files):
+        return list(self.iter_compare(scores, ignored_files))
+
+    def iter_compare(self, scores, ignored_files, executor=None):
+        """
+        Like ``compare``, but an iterator over the comparisons, run on ``executor`` or else on a
+        process pool of its own that stays open until the iterator is done. Every file is prepared
+        before the first comparison is returned, the pairs are compared as their comparisons
+        are requested, a few chunks ahead. What is prepared for a file is let go of once the
+        last pair it is in is compared.
+        """
+        if executor is None:
+            with _api.Executor() as executor:
+                yield from self.iter_compare(scores, ignored_files, executor)
+            return
 
         bar = _api.get_progress_bar()
         bar.reset(total=len(scores) if scores else 1)
         if not scores:
-            return []
+            return
 
         # Create index of ignored_files
-        ignored_index = CompareIndex(self.k)
+        ignored_index = CompareIndex(self.k, self.engine)
         for ignored_file in ignored_files:
             ignored_index.include(ignored_file)
 
@@ -83,73 +356,141 @@ class Winnowing(Comparator):
             subs.add(s.sub_a)
             subs.add(s.sub_b)
 
-        # TODO: Rename me
-        # Basically a named tuple of information we need to keep around for each file
-        @attr.s(slots=True)
-        class FileCache:
-            # List of tokens (and their corresponding indices) that can be matched.
-            # Name is slightly misleading since it is a list of (token, index) pairs
-            unignored_tokens = attr.ib(factory=list)
-            ignored_spans = attr.ib(factory=list)
-
+        # Tokenize and fingerprint every file in parallel
+        files = [file for sub in subs for file in sub]
+        chunksize = max(1, min(64, len(files) // (4 * (os.cpu_count() or 1))))
+        # Files with the same contents, lexer and preprocessor are prepared alike, so prepare one of each
+        keys = _file_keys(files, executor, chunksize)
+        unique_files = dict(zip(keys, files))
+        prepared_files = dict(zip(unique_files, executor.map(
+            self._prepare_file(ignored_index, self.k, self.engine, self.match_engine),
+            unique_files.values(), chunksize=chunksize)))
 
         file_cache = {}
-        for sub in subs:
-            for file in sub:
-                file_tokens = file.tokens()
-                cache = FileCache()
-
-                # Get list of unignored tokens
-                token_lists = ignored_index.unignored_tokens(file, tokens=file_tokens)
-                # Index each stretch of unignored tokens, index and add to the cache
-                for token_list in token_lists:
-                    index = CompareIndex(self.k)
-                    index.include(file, tokens=token_list)
-                    cache.unignored_tokens.append((token_list, index))
-
-                cache.ignored_spans = _api.missing_spans(file,
-                                                         original_tokens=file_tokens,
-                                                         processed_tokens=list(itertools.chain.from_iterable(token_lists)))
-                file_cache[file] = cache
-
-
-
-        comparisons = []
-        for score in scores:
-            ignored_spans = set()
-            span_matches = []
+        for file, key in zip(files, keys):
+            token_lists, token_ids, hashes, postings, ignored_spans = prepared_files[key]
+            if unique_files[key] is not file:
+                # Postings refer to the file they come from
+                postings = postings.copy()
+                postings[:, 0] = file.id
+
+            # Index all stretches of unignored tokens at once and add to the cache
+            index = CompareIndex(self.k, self.engine)
+            index._files[file.id] = file
+            index.include_fingerprints(hashes, postings)
+            file_cache[file] = _FileCache(unignored_tokens=token_lists,
+                                          token_ids=token_ids,
+                                          index=index,
+                                          region_starts=np.array([tokens[0].start for tokens in token_lists],
+                                                                 dtype=np.int64),
+                                          ignored_spans=[Span(file, start, end) for start, end in ignored_spans])
+        del unique_files, prepared_files
+
+        # Split the pairs, in order, into chunks of roughly the same amount of work
+        # (number of tokens involved), and compare each chunk in a worker
+        sizes = [sum(len(tokens) for file in itertools.chain(score.sub_a, score.sub_b)
+                                 for tokens in file_cache[file].unignored_tokens)
+                 for score in scores]
+        max_size = max(1, math.ceil(sum(sizes) / (4 * (os.cpu_count() or 1))))
+        if self.match_engine == "suffix_array":
+            compare_files = functools.partial(_compare_suffixes, k=self.k)
+        else:
+            compare_files = _compare_files
+        def tasks():
+            # Created just before being compared, as the files of earlier pairs are let go of
+            for chunk in _chunks(sizes, max_size=max_size):
+                pairs = [(tuple(file.id for file in score.sub_a), tuple(file.id for file in score.sub_b))
+                         for score in scores[chunk]]
+                chunk_files = {file for score in scores[chunk] for file in itertools.chain(score.sub_a, score.sub_b)}
+                yield (pairs, {file.id: attr.evolve(file_cache[file], ignored_spans=[])
+                               for file in chunk_files}, compare_files)
+
+        # The last pair that each file is in
+        last_pair = {file: i for i, score in enumerate(scores) for file in itertools.chain(score.sub_a, score.sub_b)}
+
+        # Results come in the order of the tasks, and so in order of score
+        results = itertools.chain.from_iterable(
+            _map_ahead(executor, _compare_pairs, tasks(), max_ahead=2 * (os.cpu_count() or 1)))
+        for i, (score, matches) in enumerate(zip(scores, results)):
+            files = {file.id: file for file in itertools.chain(score.sub_a, score.sub_b)}
 
             # We already have the ignored spans for every file cached, so we just need to get the list
             # for each file in this submission pair.
-            for file in itertools.chain(score.sub_a.files, score.sub_b.files):
-                ignored_spans.update(file_cache[file].ignored_spans)
-
-            # Compare each pair of files in the submission pair
-            for file_a, file_b in itertools.product(score.sub_a.files, score.sub_b.files):
-                cache_a = file_cache[file_a]
-                cache_b = file_cache[file_b]
-                # For each pair of unignored regions in the file pair, find the matching spans
-                # (by comparing their indices) and expand them as much as possible
-                for (tokens_a, index_a), (tokens_b, index_b) in itertools.product(cache_a.unignored_tokens, cache_b.unignored_tokens):
-                    span_matches += _api.expand(index_a.compare(index_b), tokens_a, tokens_b)
-
-            comparisons.append(Comparison(score.sub_a, score.sub_b, span_matches, list(ignored_spans)))
+            ignored_spans = {file: file_cache[file].ignored_spans
+                             for file in itertools.chain(score.sub_a.files, score.sub_b.files)}
+            for file in files.values():
+                if last_pair[file] == i:
+                    del file_cache[file]
+
+            span_matches = [(Span(files[file_a], start_a, end_a), Span(files[file_b], start_b, end_b))
+                            for file_a, start_a, end_a, file_b, start_b, end_b in matches]
+            yield Comparison(score.sub_a, score.sub_b, span_matches, ignored_spans)
             bar.update()
 
-        return comparisons
-
 
+    # These "functions", and _compare_pairs, run in workers. They return arrays and tuples
+    # of ints rather than indices and Spans, as those are much cheaper to send back.
     @attr.s(slots=True)
-    class _index_file:
-        """ "Function" that indexes a file and returns the index.
+    class _hash_file:
+        """ "Function" that fingerprints a file and returns its unique hashes.
         In the form of a class so that pickle can serialize it. """
         index = attr.ib()
         args = attr.ib(default=())
 
         def __call__(self, file):
-            index = self.index(*self.args)
-            index.include(file)
-            return index
+            hashes, _ = self.index(*self.args).fingerprint(file)
+            return np.unique(hashes)
+
+    @attr.s(slots=True)
+    class _prepare_file:
+        """ "Function" that tokenizes a file, splits it into stretches of tokens not in
+        ``ignored_index`` and fingerprints those, or for the suffix array match engine
+        hashes each token. Returns the stretches of tokens, the hash of every token, the
+        hashes and postings of all fingerprints, and the (start, end) of every span that is
+        ignored. In the form of a class so that pickle can serialize it. """
+        ignored_index = attr.ib()
+        k = attr.ib()
+        engine = attr.ib()
+        match_engine = attr.ib(default="fingerprints")
+
+        def __call__(self, file):
+            # Only the positions of the raw tokens are needed, so the preprocessor may change them
+            raw_tokens = file.unprocessed_tokens()
+            file_tokens = list(file.submission.preprocessor(raw_tokens))
+
+            # Get list of unignored tokens
+            token_lists = self.ignored_index.unignored_tokens(file, tokens=file_tokens)
+
+            # Spans removed by the preprocessor, and spans ignored for matching distro code
+            ignored_spans = _api._flatten_spans(
+                _api.missing_spans(file, original_tokens=raw_tokens, processed_tokens=file_tokens)
+                + _api.missing_spans(file,
+                                     original_tokens=file_tokens,
+                                     processed_tokens=list(itertools.chain.from_iterable(token_lists))))
+
+            token_lists = [token_list for token_list in token_lists if token_list]
+            token_ids = np.empty(0, dtype=np.uint64)
+            fingerprints = []
+            if self.match_engine == "suffix_array":
+                # Tokens are equal if both their type and value are
+                token_ids = np.fromiter((_token_hash(f"{token.type}:{token.val}")
+                                         for token in itertools.chain.from_iterable(token_lists)),
+                                        dtype=np.uint64)
+            else:
+                # Fingerprint each stretch separately, so that no fingerprint crosses from one to the next
+                fingerprints = [CompareIndex(self.k, self.engine).fingerprint(file, tokens=token_list)
+                                for token_list in token_lists]
+            hashes = np.concatenate([np.empty(0, dtype=np.uint64)] + [hashes for hashes, _ in fingerprints])
+            postings = np.concatenate([np.empty((0, CompareIndex.posting_width), dtype=np.int64)]
+                                      + [postings for _, postings in fingerprints])
+            return token_lists, token_ids, hashes, postings, [(span.start, span.end) for span in ignored_spans]
+
+
+#: Available fingerprinting engines
+ENGINES = ("python", "numpy")
+
+#: Available engines to find the matching spans of two files with
+MATCH_ENGINES = ("fingerprints", "suffix_array")
 
 
 class Index(abc.ABC):
@@ -158,46 +499,188 @@ class Index(abc.ABC):
     :param k: the size of the fingerprints, or equivalently the "noise threshold", the \
               number of tokens that must be identical between two files for us to consider
               it a match.
+    :param engine: the fingerprinting engine, one of ``ENGINES``
+
+    Fingerprints are kept as posting lists in compressed sparse row form: a sorted array
+    of unique hashes, and a flat array of postings (rows of ints) such that the postings of
+    ``hashes[i]`` are ``postings[offsets[i]:offsets[i + 1]]``. Newly included fingerprints
+    are buffered, with an offset to add to their first column, and merged in bulk the next
+    time the index is read.
     """
-    def __init__(self, k):
+    #: Number of int64 columns in a posting
+    posting_width = 1
+
+    def __init__(self, k, engine="python"):
         self.k = k
-        self._index = collections.defaultdict(set)
+        self.engine = engine
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._offsets = np.zeros(1, dtype=np.int64)
+        self._postings = np.empty((0, self.posting_width), dtype=np.int64)
+        # (hashes, postings, offset) that are yet to be merged in
+        self._pending = []
 
     def keys(self):
-        return self._index.keys()
+        """Sorted array of all hashes in the index."""
+        self._merge()
+        return self._hashes
 
     def values(self):
-        return self._index.values()
+        """The postings of every hash, in the same order as ``keys``."""
+        self._merge()
+        return [self._decode(self._postings[start:end])
+                for start, end in zip(self._offsets[:-1], self._offsets[1:])]
 
     def include(self, file, tokens=None):
         """Fingerprint a file and add it too the index."""
-        for hash, val in self.fingerprint(file, tokens):
-            self._index[hash].add(val)
+        self.include_fingerprints(*self.fingerprint(file, tokens))
+
+    def include_fingerprints(self, hashes, postings):
+        """Add fingerprints (as returned by ``fingerprint``) to the index."""
+        if len(hashes):
+            self._pending.append((hashes, postings, 0))
 
-    def include_all(self, other):
-        """Add all fingerprints from another index into this one."""
-        for hash, vals in other._index.items():
-            self._index[hash] |= vals
+    def include_all(self, other, offset=0):
+        """
+        Add all fingerprints from another index into this one, with ``offset`` added to the
+        first column of their postings. Those are shifted as they are merged, such that the
+        postings of other, which may be memory mapped, are not copied just for that.
+        """
+        other._merge()
+        if len(other._hashes):
+            self._pending.append((np.repeat(other._hashes, np.diff(other._offsets)), other._postings, offset))
         return self
 
     def ignore_all(self, other):
         """Remove all fingerprints in another index from this one."""
-        for hash in other._index:
-            self._index.pop(hash, None)
+        self._select(~np.isin(self.keys(), other.keys(), assume_unique=True))
 
-    def kgrams(self, iterable):
+    def drop_frequent(self, max_postings):
         """
-        Create an iterator over all contiguous sequences of k items (kgrams) from
-        ``iterable``.
+        Remove all hashes with more than ``max_postings`` postings from the index.
+        Returns the number of hashes removed.
         """
-        iters = itertools.tee(iterable, self.k)
-        for i, it in enumerate(iters):
-            next(itertools.islice(it, i, i), None)
-        return zip(*iters)
+        self._merge()
+        is_frequent = np.diff(self._offsets) > max_postings
+        self._select(~is_frequent)
+        return int(is_frequent.sum())
+
+    def _merge(self):
+        """Merge any pending fingerprints into the posting lists."""
+        if not self._pending:
+            return
+
+        hashes = np.concatenate([np.repeat(self._hashes, np.diff(self._offsets))]
+                                + [hashes for hashes, _, _ in self._pending])
+        postings = np.concatenate([self._postings] + [postings for _, postings, _ in self._pending])
+        start = len(self._postings)
+        for _, pending_postings, offset in self._pending:
+            postings[start:start + len(pending_postings), 0] += offset
+            start += len(pending_postings)
+        self._pending = []
+
+        # Sort by hash, then by posting, and drop duplicate postings per hash
+        order = np.lexsort(tuple(postings.T[::-1]) + (hashes,))
+        hashes = hashes[order]
+        postings = postings[order]
+        is_new = np.ones(len(hashes), dtype=bool)
+        is_new[1:] = (hashes[1:] != hashes[:-1]) | (postings[1:] != postings[:-1]).any(axis=1)
+        hashes = hashes[is_new]
+
+        is_first = np.ones(len(hashes), dtype=bool)
+        is_first[1:] = hashes[1:] != hashes[:-1]
+        self._hashes = hashes[is_first]
+        self._offsets = np.append(np.flatnonzero(is_first), len(hashes))
+        self._postings = postings[is_new]
+
+    def _select(self, mask):
+        """Keep only the hashes (and their postings) for which ``mask`` is set."""
+        # Keeping all would only copy (memory mapped) posting lists
+        if mask.all():
+            return
+        counts = np.diff(self._offsets)
+        self._postings = self._postings[np.repeat(mask, counts)]
+        self._hashes = self._hashes[mask]
+        self._offsets = np.concatenate(([0], np.cumsum(counts[mask])))
+
+    def _subset(self, mask=None):
+        """
+        A copy of the index with only the postings for which ``mask`` is set (all if
+        ``None``), and only the hashes that have any postings left.
+        """
+        self._merge()
+        subset = copy.copy(self)
+        subset._pending = []
+        if mask is None:
+            return subset
+
+        counts = np.bincount(np.repeat(np.arange(len(self._hashes)), np.diff(self._offsets))[mask],
+                             minlength=len(self._hashes))
+        subset._hashes = self._hashes[counts > 0]
+        subset._offsets = np.concatenate(([0], np.cumsum(counts[counts > 0])))
+        subset._postings = self._postings[mask]
+        return subset
+
+    def _common(self, other):
+        """
+        Merge join on the sorted hashes of self and other. Returns the positions
+        of the common hashes in self and in other.
+        """
+        hashes, other_hashes = self.keys(), other.keys()
+        positions = np.searchsorted(other_hashes, hashes)
+        found = positions < len(other_hashes)
+        found[found] = other_hashes[positions[found]] == hashes[found]
+        return np.flatnonzero(found), positions[found]
+
+    def _decode(self, postings):
+        """Turn the postings of a single hash back into objects."""
+        return set(postings[:, 0].tolist())
+
+    def save(self, directory):
+        """Write the posting lists to ``.npy`` files in ``directory``."""
+        self._merge()
+        for name in ("hashes", "offsets", "postings"):
+            np.save(pathlib.Path(directory) / f"{name}.npy", getattr(self, f"_{name}"))
+
+    def load(self, directory, mmap=True):
+        """
+        Replace the posting lists with those saved in ``directory``. If ``mmap`` is set,
+        the files are memory mapped (read-only) instead of read into memory.
+        """
+        for name in ("hashes", "offsets", "postings"):
+            setattr(self, f"_{name}", np.load(pathlib.Path(directory) / f"{name}.npy",
+                                              mmap_mode="r" if mmap else None))
+        self._pending = []
+        return self
 
     def hashes(self, tokens):
-        """Hash each contiguous sequence of k tokens in ``tokens``."""
-        return (hash("".join(kgram)) for kgram in self.kgrams(t.val for t in tokens))
+        """
+        Hash each contiguous sequence of k tokens in ``tokens``. Every token value is
+        hashed on its own, then the k-gram hash is rolled along as a polynomial of those
+        (mod 2**64). The resulting 64-bit hashes do not depend on ``PYTHONHASHSEED``,
+        so they are stable across processes, runs and machines.
+        """
+        ids = [_token_hash(t.val) for t in tokens]
+        if len(ids) < self.k:
+            return
+
+        hash_ = 0
+        for id in ids[:self.k]:
+            hash_ = (hash_ * _HASH_BASE + id) & _HASH_MASK
+        yield hash_
+
+        # Weight of the token that drops out of the k-gram
+        weight = pow(_HASH_BASE, self.k - 1, _HASH_MASK + 1)
+        for old, new in zip(ids, ids[self.k:]):
+            hash_ = ((hash_ - old * weight) * _HASH_BASE + new) & _HASH_MASK
+            yield hash_
+
+    def hash_array(self, tokens):
+        """
+        Vectorized counterpart of ``hashes``, returns an ``np.uint64`` array with the
+        same hash for each k-gram.
+        """
+        ids = np.fromiter((_token_hash(t.val) for t in tokens), dtype=np.uint64, count=len(tokens))
+        return _kgram_hashes(ids, self.k)
 
     @abc.abstractmethod
     def compare(self, other):
@@ -205,105 +688,686 @@ class Index(abc.ABC):
 
     @abc.abstractmethod
     def fingerprint(self, file, tokens=None):
+        """Returns an array of hashes and an array with a posting for each."""
         pass
 
     def __bool__(self):
-        return bool(self._index)
+        return bool(len(self._hashes)) or any(len(hashes) for hashes, _, _ in self._pending)
 
 
 class ScoreIndex(Index):
-    def __init__(self, k, t):
-        super().__init__(k)
+    """Index from fingerprints to the ids of the submissions containing them."""
+    def __init__(self, k, t, engine="python"):
+        super().__init__(k, engine)
         self.w = t - k + 1
-        self._max_id = 0
 
-    def include(self, file, tokens=None):
-        super().include(file, tokens)
-        self._max_id = max(self._max_id, file.submission.id)
-
-    def include_all(self, other):
-        super().include_all(other)
-        self._max_id = max(self._max_id, other._max_id)
+    def compare(self, other, score=lambda hashes: 1, executor=None):
+        """
+        Score every pair of submissions (one from self, one from other) that share
+        fingerprints. ``score`` maps an array of common hashes to their weights. Scored
+        on ``executor`` if given, in this process otherwise.
+        """
+        # Only pairs that share a fingerprint get a score, so accumulate those sparsely
+        # instead of keeping a (max id + 1) by (max id + 1) matrix around
+        scores = _PairScores(other._postings[:, 0].max() + 1 if len(other.keys()) else 0)
+        self.score_pairs(other, scores, executor if executor is not None else _api.FauxExecutor(),
+                         weight=lambda hashes: _to_fixed_point(score(hashes)))
 
-    def compare(self, other, score=lambda _: 1):
-        # Keep a self.max_file_id by other.max_file_id matrix for counting score
-        scores = np.zeros((self._max_id + 1, other._max_id + 1), dtype=np.float64)
+        # Return only those Scores with a score > 0 from different submissions
+        return scores.nonzero()
 
-        # Find common fingerprints (hashes)
-        common_hashes = set(self._index) & set(other._index)
+    def score_pairs(self, other, pair_scores, executor, weight, count=lambda hashes: 1):
+        """
+        Add to ``pair_scores`` (a ``_PairScores``), for every pair of submissions (one from
+        self, one from other, ordered by id) the number of fingerprints they share, and the
+        total weight of those. ``weight`` and ``count`` map an array of common hashes to
+        their (fixed point) weights and to the number of times they should be counted.
+        The common hashes are split into shards that are scored in parallel on ``executor``.
+        """
+        idxs, other_idxs = self._common(other)
+        weights = np.broadcast_to(weight(self._hashes[idxs]), idxs.shape).astype(np.int64)
+        counts = np.broadcast_to(count(self._hashes[idxs]), idxs.shape).astype(np.int64)
 
         bar = _api.get_progress_bar()
         try:
-            update_amount = (bar.total - bar.n - 1) / len(common_hashes)
+            update_amount = (bar.total - bar.n - 1) / len(idxs)
         except ZeroDivisionError:
             pass
 
-        for hash_ in common_hashes:
-            bar.update(update_amount)
+        # Shards of about equal numbers of pairs, a few per core so that the load stays balanced
+        sizes = _product_sizes(self._offsets, idxs, other._offsets, other_idxs)
+        shard_size = min(1 << 22, max(1 << 16, math.ceil(sizes.sum() / (4 * (os.cpu_count() or 1)))))
+        shards = list(_chunks(sizes, max_size=shard_size))
 
-            # All file_ids associated with fingerprint in self
-            index1 = self._index[hash_]
-            # All file_ids associated with fingerprint in other
-            index2 = other._index[hash_]
-            if index1 and index2:
-                # Create the product of all file_ids from self and other
-                # https://stackoverflow.com/questions/28684492/numpy-equivalent-of-itertools-product
-                index = np.array(np.meshgrid([id for id in index1],
-                                             [id for id in index2])).T.reshape(-1, 2)
+        partial_scores = executor.map(_score_shard, ((
+            *_shard_postings(self._offsets, self._postings, idxs[shard]),
+            *_shard_postings(other._offsets, other._postings, other_idxs[shard]),
+            counts[shard], weights[shard], pair_scores.width) for shard in shards))
 
-                # Add 1 to all combo's (the product) of file_ids from self and other
-                scores[index[:, 0], index[:, 1]] += score(hash_)
+        for shard, (keys, partial_counts, partial_weights) in zip(shards, partial_scores):
+            pair_scores.merge(keys, partial_counts, partial_weights)
+            bar.update(update_amount * (shard.stop - shard.start))
 
-        # Return only those Scores with a score > 0 from different submissions
-        return [Score(Submission.get(id1), Submission.get(id2), scores[id1][id2])
-                for id1, id2 in zip(*np.where(np.triu(scores, 1) > 0))]
+        return pair_scores
 
     def fingerprint(self, file, tokens=None):
         if not tokens:
             tokens = file.tokens()
             if not tokens:
-                return []
-
-        hashes = self.hashes(tokens)
-
-        fingerprints = []
-
-        # circular buffer holding window
-        buf = [(math.inf, Span(None, 0, 0))] * self.w
-        # index of minimum hash in buffer
-        min_idx = 0
-        for hash_, idx in zip(hashes, itertools.cycle(range(self.w))):
-            buf[idx] = hash_, file.submission.id
-            if min_idx == idx:
-                # old min not in window, search left for new min
-                for j in range(1, self.w):
-                    search_idx = (idx - j) % self.w
-                    if buf[search_idx][0] < buf[min_idx][0]:
-                        min_idx = search_idx
-                fingerprints.append(buf[min_idx])
-            else:
-                # compare new hash to old min (robust winnowing)
-                if buf[idx][0] < buf[min_idx][0]:
-                    min_idx = idx
-                    fingerprints.append(buf[min_idx])
-        return fingerprints
+                return np.empty(0, dtype=np.uint64), np.empty((0, 1), dtype=np.int64)
+
+        if self.engine == "numpy":
+            hashes = self.hash_array(tokens)
+            hashes = hashes[_winnow_array(hashes, self.w)]
+        else:
+            hashes = list(self.hashes(tokens))
+            hashes = np.array([hashes[i] for i in _winnow(hashes, self.w)], dtype=np.uint64)
+
+        return hashes, np.full((len(hashes), 1), file.submission.id, dtype=np.int64)
+
+
+def _winnow(hashes, w):
+    """
+    Robust winnowing: yield the position of the minimum hash of every window of
+    ``w`` consecutive hashes, only yielding a new position if the minimum changes.
+    Ties are broken in favour of the minimum that was already selected and
+    otherwise in favour of the rightmost one.
+    """
+    # circular buffer holding window
+    buf = [(math.inf, -1)] * w
+    # index of minimum hash in buffer
+    min_idx = 0
+    for i, (hash_, idx) in enumerate(zip(hashes, itertools.cycle(range(w)))):
+        buf[idx] = hash_, i
+        if min_idx == idx:
+            # old min not in window, search left for new min
+            for j in range(1, w):
+                search_idx = (idx - j) % w
+                if buf[search_idx][0] < buf[min_idx][0]:
+                    min_idx = search_idx
+            yield buf[min_idx][1]
+        else:
+            # compare new hash to old min (robust winnowing)
+            if buf[idx][0] < buf[min_idx][0]:
+                min_idx = idx
+                yield buf[min_idx][1]
+
+
+def _winnow_array(hashes, w):
+    """
+    Vectorized counterpart of ``_winnow``, returns an array of positions.
+
+    The minimum only changes when either a hash smaller than everything in the
+    preceding window arrives, or when the current minimum slides out of the window.
+    The former are found with array operations, so only the selected fingerprints
+    themselves are visited in Python.
+    """
+    n = len(hashes)
+    if not n:
+        return np.empty(0, dtype=np.int64)
+
+    # Minimum of the w hashes preceding every position
+    padded = np.concatenate((np.full(w, np.iinfo(hashes.dtype).max, dtype=hashes.dtype), hashes))
+    preceding_min = np.lib.stride_tricks.sliding_window_view(padded, w)[:n].min(axis=1)
+
+    # Positions holding a hash smaller than anything in the window before them
+    new_mins = np.flatnonzero(hashes < preceding_min).tolist()
+    if not new_mins or new_mins[0] != 0:
+        new_mins.insert(0, 0)
+
+    # Position of the rightmost minimum of the window ending at position i + w - 1
+    if n >= w:
+        windows = np.lib.stride_tricks.sliding_window_view(hashes, w)
+        rightmost_mins = (w - 1 - np.argmin(windows[:, ::-1], axis=1) + np.arange(len(windows))).tolist()
+
+    positions = [0]
+    next_idx = 1
+    while True:
+        # Whichever comes first: a new smaller hash, or the current minimum expiring
+        expires = positions[-1] + w
+        next_min = new_mins[next_idx] if next_idx < len(new_mins) else n
+        if next_min <= expires:
+            if next_min >= n:
+                break
+            positions.append(next_min)
+            next_idx += 1
+        else:
+            if expires >= n:
+                break
+            positions.append(rightmost_mins[expires - w + 1])
+
+    return np.array(positions, dtype=np.int64)
+
+
+def _kgram_hashes(ids, k):
+    """Polynomial hash of every contiguous sequence of ``k`` ids in ``ids`` (``np.uint64``)."""
+    n = len(ids) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+
+    base = np.uint64(_HASH_BASE)
+    hashes = np.zeros(n, dtype=np.uint64)
+    for i in range(k):
+        # Arithmetic on uint64 arrays wraps around, i.e. everything is mod 2**64
+        hashes = hashes * base + ids[i:i + n]
+    return hashes
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _token_hash(val):
+    """Stable 64-bit hash of a token value."""
+    digest = hashlib.blake2b(val.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+# Odd multiplier for the polynomial k-gram hash
+_HASH_BASE = 0x100000001b3
+_HASH_MASK = (1 << 64) - 1
+
+# Bump whenever the hashes, or the layout of the archive cache, change
+_ARCHIVE_CACHE_VERSION = 1
+
+
+def _preprocessor_key(preprocessor):
+    """
+    Identify a preprocessor by the names and the compiled code of the functions it
+    consists of. Returns ``None`` if that's not possible (e.g. for builtins).
+    """
+    functions = getattr(preprocessor, "preprocessors", [preprocessor])
+    try:
+        return tuple(f"{f.__module__}.{f.__qualname__}:{hashlib.blake2b(marshal.dumps(f.__code__)).hexdigest()}"
+                     for f in functions)
+    except (AttributeError, ValueError):
+        return None
+
+
+def _content_digest(file):
+    """
+    Digest of the contents of ``file`` and of the lexer that tokenizes it, files with the
+    same digest have the same raw tokens.
+    """
+    lexer = type(file.lexer())
+    return f"{file.digest()}:{lexer.__module__}.{lexer.__qualname__}"
+
+
+def _file_keys(files, executor, chunksize=1):
+    """
+    Key of each of ``files``, files with the same key have the same contents, lexer and
+    preprocessor, and so the same tokens. The contents are digested by ``executor``.
+    """
+    preprocessor_keys = {}
+    for file in files:
+        preprocessor = file.submission.preprocessor
+        if id(preprocessor) not in preprocessor_keys:
+            key = _preprocessor_key(preprocessor)
+            preprocessor_keys[id(preprocessor)] = key if key is not None else id(preprocessor)
+    digests = executor.map(_content_digest, files, chunksize=chunksize)
+    return [(digest, preprocessor_keys[id(file.submission.preprocessor)]) for file, digest in zip(files, digests)]
+
+
+def _frequencies(*pairs):
+    """
+    Combine (hashes, counts) pairs of unique hashes and the number of files they
+    occur in into a single such pair.
+    """
+    hashes, inverse = np.unique(np.concatenate([hashes for hashes, _ in pairs]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts for _, counts in pairs]), minlength=len(hashes))
+    return hashes, counts.astype(np.int64)
+
+
+def _submission_digest(sub):
+    """Digest of the path, and the names, sizes and modification times of the files of ``sub``."""
+    digest = hashlib.blake2b(json.dumps(str(sub.path)).encode())
+    for file in sub:
+        stat = file.stat()
+        digest.update(json.dumps([str(file.name), stat.st_size, stat.st_mtime_ns]).encode())
+    return digest.hexdigest()
+
+
+def _load_arrays(directory, header, index, names):
+    """
+    Load an index and named arrays saved by ``_save_arrays`` into ``index``, memory mapped.
+    Returns a dict with the arrays, or ``None`` if there is nothing (readable) saved, or if
+    it was saved with a different header.
+    """
+    try:
+        with open(directory / "header.json") as f:
+            if json.load(f) != json.loads(json.dumps(header)):
+                return None
+        index.load(directory)
+        return {name: np.load(directory / f"{name}.npy", mmap_mode="r") for name in names}
+    except (OSError, ValueError):
+        return None
+
+
+def _save_arrays(directory, header, index, arrays):
+    """
+    Save an index and a dict of named arrays to ``directory``, replacing whatever is there.
+    """
+    directory.parent.mkdir(parents=True, exist_ok=True)
+
+    # Write everything to a temporary directory first, so that nothing is ever half written
+    tmp = pathlib.Path(tempfile.mkdtemp(prefix=f".{directory.name}-", dir=directory.parent))
+    try:
+        index.save(tmp)
+        for name, array in arrays.items():
+            np.save(tmp / f"{name}.npy", array)
+        with open(tmp / "header.json", "w") as f:
+            json.dump(header, f)
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(tmp, directory)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+@attr.s(slots=True)
+class _ScoreState:
+    """
+    Everything ``Winnowing.score`` needs to score more submissions later on: the index of
+    all submissions (with positions as postings, see ``Winnowing.score``), the number of
+    files every hash occurs in, the hashes of distro code, and the scores of all pairs.
+    """
+    index = attr.ib()
+    frequencies = attr.ib()
+    ignored_hashes = attr.ib()
+    pair_scores = attr.ib()
+    n_submissions = attr.ib()
+    n_archives = attr.ib()
+    # Positions of the submissions in the state, if loaded into a later run
+    positions = attr.ib(default=None)
+
+    @classmethod
+    def load(cls, directory, header, index, submissions, archive_submissions):
+        """
+        Load the state saved by an earlier run over (a subset of) ``submissions`` and
+        ``archive_submissions``, with positions as in this run. Returns ``None`` if there
+        is none, or if any submission of the earlier run changed since.
+        """
+        arrays = _load_arrays(directory, header, index, (
+            "frequency_hashes", "frequencies", "ignored_hashes", "paths", "is_archive", "digests",
+            "pair_ids1", "pair_ids2", "pair_counts", "pair_weights"))
+        if arrays is None:
+            return None
+
+        all_submissions = submissions + archive_submissions
+        current = {(str(sub.path), i >= len(submissions)): i for i, sub in enumerate(all_submissions)}
+        try:
+            positions = np.array([current[path, bool(is_archive)] for path, is_archive
+                                  in zip(arrays["paths"].tolist(), arrays["is_archive"].tolist())], dtype=np.int64)
+        except KeyError:
+            return None
+        if any(_submission_digest(all_submissions[position]) != digest
+               for position, digest in zip(positions.tolist(), arrays["digests"].tolist())):
+            return None
+
+        index._postings = positions[index._postings]
+        pair_scores = _PairScores(len(all_submissions))
+        pair_scores.merge(positions[arrays["pair_ids1"]] * pair_scores.width + positions[arrays["pair_ids2"]],
+                          np.asarray(arrays["pair_counts"]), np.asarray(arrays["pair_weights"]))
+
+        return cls(index=index, frequencies=(arrays["frequency_hashes"], arrays["frequencies"]),
+                   ignored_hashes=arrays["ignored_hashes"], pair_scores=pair_scores,
+                   n_submissions=int((~arrays["is_archive"]).sum()), n_archives=int(arrays["is_archive"].sum()),
+                   positions=positions)
+
+    def save(self, directory, header, submissions):
+        """Save the state, ``submissions`` being all submissions in order of position."""
+        ids1, ids2, counts, weights = self.pair_scores.arrays()
+        is_pair = counts != 0
+        _save_arrays(directory, header, self.index, {
+            "frequency_hashes": self.frequencies[0],
+            "frequencies": self.frequencies[1],
+            "ignored_hashes": self.ignored_hashes,
+            "paths": np.array([str(sub.path) for sub in submissions], dtype=str),
+            "is_archive": np.arange(len(submissions)) >= self.n_submissions,
+            "digests": np.array([_submission_digest(sub) for sub in submissions], dtype=str),
+            "pair_ids1": ids1[is_pair],
+            "pair_ids2": ids2[is_pair],
+            "pair_counts": counts[is_pair],
+            "pair_weights": weights[is_pair]
+        })
+
+
+def _product_sizes(offsets, idxs, other_offsets, other_idxs):
+    """Number of posting pairs for each pair of posting lists."""
+    return np.diff(offsets)[idxs] * np.diff(other_offsets)[other_idxs]
+
+
+def _product(offsets, idxs, other_offsets, other_idxs):
+    """
+    Vectorized product of posting lists: for every ``i``, pair each posting of
+    ``idxs[i]`` with each posting of ``other_idxs[i]``. Returns, for every pair,
+    ``i`` and the rows of both postings.
+    """
+    sizes = np.diff(offsets)[idxs]
+    other_sizes = np.diff(other_offsets)[other_idxs]
+    n_pairs = sizes * other_sizes
+
+    groups = np.repeat(np.arange(len(idxs)), n_pairs)
+    # Position of each pair within the product of its group
+    positions = np.arange(n_pairs.sum()) - np.repeat(np.cumsum(n_pairs) - n_pairs, n_pairs)
+    rows = offsets[idxs][groups] + positions // other_sizes[groups]
+    other_rows = other_offsets[other_idxs][groups] + positions % other_sizes[groups]
+    return groups, rows, other_rows
+
+
+def _chunks(sizes, max_size=1 << 20):
+    """
+    Split range(len(sizes)) into consecutive slices whose sizes add up to at most
+    ``max_size``, or to a single element if that alone is larger.
+    """
+    cumulative_sizes = np.cumsum(sizes)
+    start = 0
+    while start < len(sizes):
+        offset = cumulative_sizes[start - 1] if start else 0
+        end = max(int(np.searchsorted(cumulative_sizes, offset + max_size, side="right")), start + 1)
+        yield slice(start, end)
+        start = end
+
+
+def _posting_rows(offsets, idxs):
+    """Rows of all postings of the hashes at positions ``idxs``."""
+    counts = np.diff(offsets)[idxs]
+    return np.repeat(offsets[idxs], counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+def _shard_postings(offsets, postings, idxs):
+    """
+    The posting lists of the hashes at positions ``idxs`` as a standalone pair of
+    offsets and submission ids, small enough to send to another process.
+    """
+    shard_offsets = np.concatenate(([0], np.cumsum(np.diff(offsets)[idxs])))
+    return shard_offsets, postings[_posting_rows(offsets, idxs), 0]
+
+
+def _score_shard(shard):
+    """
+    Sum the counts and (fixed point) weights of all pairs of submissions that share a
+    hash from a shard of common hashes, as built by ``ScoreIndex.score_pairs``. Returns
+    the keys of the pairs (see ``_PairScores``), their counts and their weights.
+    """
+    offsets, ids, other_offsets, other_ids, counts, weights, width = shard
+    idxs = np.arange(len(weights))
+
+    # Create the product of all submission ids from self and other per common hash,
+    # keeping only pairs from different submissions (ordered by id)
+    groups, rows, other_rows = _product(offsets, idxs, other_offsets, idxs)
+    ids1 = ids[rows]
+    ids2 = other_ids[other_rows]
+    is_pair = ids1 < ids2
+
+    groups = groups[is_pair]
+    return _sum_by_key(ids1[is_pair] * width + ids2[is_pair], counts[groups], weights[groups])
+
+
+@attr.s(slots=True)
+class _FileCache:
+    """What the compare phase needs to keep around for each file."""
+    # List of stretches (regions) of tokens that can be matched
+    unignored_tokens = attr.ib(factory=list)
+    # Hash of every token in those regions, for the suffix array match engine
+    token_ids = attr.ib(factory=lambda: np.empty(0, dtype=np.uint64))
+    # Index of the fingerprints of all regions, none of which cross a region boundary
+    index = attr.ib(default=None)
+    # Start of the first token of each region, to tell which region a posting is in
+    region_starts = attr.ib(factory=lambda: np.empty(0, dtype=np.int64))
+    # Sorted spans without overlap that are ignored, including those the preprocessor removed
+    ignored_spans = attr.ib(factory=list)
+
+    def regions(self, postings):
+        """The region of each of ``postings``."""
+        return np.searchsorted(self.region_starts, postings[:, 1], side="right") - 1
+
+
+def _compare_files(cache_a, cache_b):
+    """
+    Find the matching spans of two files with a single intersection of their indices,
+    and expand them as much as possible within the regions they are in. Returns the
+    (start, end) of the span in either file for every match.
+    """
+    idxs_a, idxs_b = cache_a.index._common(cache_b.index)
+    _, rows_a, rows_b = _product(cache_a.index._offsets, idxs_a, cache_b.index._offsets, idxs_b)
+    if not len(rows_a):
+        return []
+
+    # Group the matches by the pair of regions they are in
+    regions_a = cache_a.regions(cache_a.index._postings[rows_a])
+    regions_b = cache_b.regions(cache_b.index._postings[rows_b])
+    order = np.lexsort((regions_b, regions_a))
+    regions_a, regions_b = regions_a[order], regions_b[order]
+    spans_a, spans_b = cache_a.index._spans(rows_a[order]), cache_b.index._spans(rows_b[order])
+    is_first = np.ones(len(order), dtype=bool)
+    is_first[1:] = (regions_a[1:] != regions_a[:-1]) | (regions_b[1:] != regions_b[:-1])
+    bounds = np.append(np.flatnonzero(is_first), len(order)).tolist()
+
+    span_matches = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        span_matches += _api.expand(list(zip(spans_a[start:end], spans_b[start:end])),
+                                    cache_a.unignored_tokens[regions_a[start]],
+                                    cache_b.unignored_tokens[regions_b[start]])
+    return [(span_a.start, span_a.end, span_b.start, span_b.end) for span_a, span_b in span_matches]
+
+
+def _compare_suffixes(cache_a, cache_b, k):
+    """
+    Find the maximal matching spans of at least ``k`` tokens of two files directly, with a
+    suffix array over the tokens of both. Returns the (start, end) of the span in either
+    file for every match.
+    """
+    if not cache_a.unignored_tokens or not cache_b.unignored_tokens:
+        return []
+
+    # Number the tokens of all regions of both files, and follow each region by an id of
+    # its own, so that no match crosses from one region into the next
+    regions = cache_a.unignored_tokens + cache_b.unignored_tokens
+    _, ids = np.unique(np.concatenate((cache_a.token_ids, cache_b.token_ids)), return_inverse=True)
+    ends = np.cumsum([len(tokens) for tokens in regions])
+    ids = np.insert(ids, ends, ids.max() + 1 + np.arange(len(regions)))
+    # Position of each id among the tokens of all regions (-1 for separators)
+    positions = np.insert(np.arange(ends[-1]), ends, -1)
+
+    starts_a, starts_b, lengths = _suffix_array.maximal_matches(
+        ids, len(cache_a.token_ids) + len(cache_a.unignored_tokens), k)
+    starts_a, starts_b = positions[starts_a], positions[starts_b]
+
+    tokens = list(itertools.chain.from_iterable(regions))
+    return [(tokens[start_a].start, tokens[start_a + length - 1].end,
+             tokens[start_b].start, tokens[start_b + length - 1].end)
+            for start_a, start_b, length in zip(starts_a.tolist(), starts_b.tolist(), lengths.tolist())]
+
+
+def _map_ahead(executor, fn, iterable, max_ahead):
+    """
+    Like ``executor.map(fn, iterable)``, but with at most ``max_ahead`` results computed
+    ahead of the one being returned, rather than all of them.
+    """
+    in_flight = collections.deque()
+    for item in iterable:
+        in_flight.append(executor.submit(fn, item))
+        if len(in_flight) > max_ahead:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+
+def _compare_pairs(task):
+    """
+    Compare a chunk of submission pairs. ``task`` holds the pairs, each as the ids of
+    the files of both submissions, the ``_FileCache`` of those files by id, and the
+    function to compare two of those with.
+    Returns, for each pair, its span matches as (file id, start, end) * 2 tuples.
+    """
+    pairs, file_cache, compare_files = task
+    results = []
+    for files_a, files_b in pairs:
+        span_matches = []
+        # Compare each pair of files in the submission pair
+        for file_a, file_b in itertools.product(files_a, files_b):
+            span_matches += [(file_a, start_a, end_a, file_b, start_b, end_b) for start_a, end_a, start_b, end_b
+                             in compare_files(file_cache[file_a], file_cache[file_b])]
+        results.append(span_matches)
+    return results
+
+
+def _sum_by_key(keys, *values):
+    """
+    Sum each of ``values`` over equal ``keys``. Returns the sorted unique keys, followed
+    by the sums of each of ``values``.
+    """
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    is_first = np.ones(len(keys), dtype=bool)
+    is_first[1:] = keys[1:] != keys[:-1]
+    starts = np.flatnonzero(is_first)
+    if not len(starts):
+        return (keys, *(vals[:0] for vals in values))
+    return (keys[starts], *(np.add.reduceat(vals[order], starts) for vals in values))
+
+
+# Scores are summed as integers in units of 2**-32, so that sums are exact and the same
+# no matter how the work was split up
+_FIXED_POINT_SCALE = 1 << 32
+
+
+def _to_fixed_point(scores):
+    return np.rint(np.asarray(scores, dtype=np.float64) * _FIXED_POINT_SCALE).astype(np.int64)
+
+
+class _PairScores:
+    """
+    Sparse accumulator for the scores of submission pairs: the number of fingerprints a
+    pair shares, and their total (fixed point) weight. Updates are buffered as (key,
+    count, weight) triplets, with key ``id1 * width + id2``, that are periodically reduced
+    by summing duplicate keys, so memory grows with the number of distinct pairs rather
+    than with the square of the id space.
+    :param width: one more than the largest id that can appear as the second \
+                  element of a pair
+    """
+    # Minimal number of buffered updates after which they're reduced
+    _max_buffered = 1 << 20
+
+    def __init__(self, width):
+        self.width = width
+        self._keys = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._weights = np.empty(0, dtype=np.int64)
+        self._buffer = []
+        self._n_buffered = 0
+
+    def add(self, ids1, ids2, score):
+        """Add ``score`` (or ``score[i]``) to every pair (``ids1[i]``, ``ids2[i]``)."""
+        keys = ids1 * self.width + ids2
+        self.merge(keys, np.ones(keys.shape, dtype=np.int64), np.broadcast_to(_to_fixed_point(score), keys.shape))
+
+    def merge(self, keys, counts, weights):
+        """Add ``counts[i]`` and fixed point ``weights[i]`` to the pair with key ``keys[i]``."""
+        if not len(keys):
+            return
+        self._buffer.append((keys, counts, weights))
+        self._n_buffered += len(keys)
+        # Reduce at most once per doubling in size, to keep merging linearithmic
+        if self._n_buffered >= max(self._max_buffered, len(self._keys)):
+            self._reduce()
+
+    def arrays(self):
+        """The ids of both submissions of every pair, and their counts and weights."""
+        self._reduce()
+        return (*np.divmod(self._keys, self.width), self._counts, self._weights)
+
+    def items(self):
+        """Yield (id1, id2, weight) for every pair, ordered by (id1, id2)."""
+        ids1, ids2, _, weights = self.arrays()
+        return zip(ids1.tolist(), ids2.tolist(), weights / _FIXED_POINT_SCALE)
+
+    def nonzero(self, base=0, submissions=None):
+        """
+        The pairs with a score > 0, as ``_Scores``. The score of a pair is its weight plus
+        ``base`` (fixed point) for every fingerprint it shares. Ids are looked up in
+        ``submissions`` if given, and are ``Submission`` ids otherwise.
+        """
+        ids1, ids2, counts, weights = self.arrays()
+        scores = counts * base + weights
+        is_nonzero = scores > 0
+        return _Scores(ids1[is_nonzero], ids2[is_nonzero], scores[is_nonzero] / _FIXED_POINT_SCALE,
+                       submissions=submissions)
+
+    def __len__(self):
+        self._reduce()
+        return len(self._keys)
+
+    def _reduce(self):
+        if not self._buffer:
+            return
+
+        self._keys, self._counts, self._weights = _sum_by_key(*(
+            np.concatenate([getattr(self, name)] + [update[i] for update in self._buffer])
+            for i, name in enumerate(("_keys", "_counts", "_weights"))))
+        self._buffer = []
+        self._n_buffered = 0
+
+
+class _Scores(collections.abc.Sequence):
+    r"""
+    Sequence of the ``Score``\ s of submission pairs (``ids1[i]``, ``ids2[i]``) with
+    score ``values[i]``. Ids are positions in ``submissions`` if given, ``Submission`` ids
+    otherwise. ``Score`` objects are only created for the pairs that are looked at, so
+    that the top few out of millions of pairs can be found with ``nlargest`` without
+    creating millions of objects.
+    """
+    def __init__(self, ids1, ids2, values, submissions=None):
+        self._ids1 = ids1
+        self._ids2 = ids2
+        self._values = values
+        self._get = Submission.get if submissions is None else submissions.__getitem__
+
+    def nlargest(self, n):
+        """The ``n`` highest scores, highest first. Same as ``heapq.nlargest(n, self)``."""
+        if n <= 0:
+            return []
+
+        candidates = np.arange(len(self))
+        if n < len(self):
+            # Everything tied with the nth highest score is a candidate, the first of those win
+            threshold = np.partition(self._values, len(self) - n)[len(self) - n]
+            candidates = np.flatnonzero(self._values >= threshold)
+        order = candidates[np.argsort(-self._values[candidates], kind="stable")[:n]]
+        return [self[i] for i in order]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Score(self._get(int(self._ids1[i])), self._get(int(self._ids2[i])), self._values[i])
+
+    def __iter__(self):
+        for id1, id2, value in zip(self._ids1.tolist(), self._ids2.tolist(), self._values):
+            yield Score(self._get(id1), self._get(id2), value)
+
+    def __len__(self):
+        return len(self._values)
 
 
 class CompareIndex(Index):
-    def compare(self, other):
-        matches = []
+    """Index from fingerprints to the spans (file id, start, end) they come from."""
+    posting_width = 3
 
-        # Find common fingerprints (hashes)
-        common_hashes = set(self._index) & set(other._index)
-        for hash_ in common_hashes:
-            # All spans associated with fingerprint in self
-            spans_a = self._index[hash_]
-            # All spans associated with fingerprint in other
-            spans_b = other._index[hash_]
-            matches.extend((span_a, span_b)
-                           for span_a, span_b in itertools.product(spans_a, spans_b))
+    def __init__(self, k, engine="python"):
+        super().__init__(k, engine)
+        # Every file referred to by a posting, by id
+        self._files = {}
 
-        return matches
+    def include(self, file, tokens=None):
+        self._files[file.id] = file
+        super().include(file, tokens)
+
+    def include_all(self, other, offset=0):
+        self._files.update(other._files)
+        return super().include_all(other, offset)
+
+    def compare(self, other):
+        idxs, other_idxs = self._common(other)
+        groups, rows, other_rows = _product(self._offsets, idxs, other._offsets, other_idxs)
+        return list(zip(self._spans(rows), other._spans(other_rows)))
 
     def unignored_tokens(self, file, tokens=None):
         if tokens is None:
@@ -314,36 +1378,35 @@ class CompareIndex(Index):
             return [tokens]
 
         # Create an index of file with same settings as self
-        file_index = CompareIndex(k=self.k)
+        file_index = CompareIndex(k=self.k, engine=self.engine)
         file_index.include(file, tokens=tokens)
 
         # Figure out spans (regions) of the file to ignore
         # Note: these can overlap!
-        ignored_spans = []
-        for hash, spans in file_index._index.items():
-            if hash in self._index:
-                ignored_spans.extend(spans)
+        idxs, _ = file_index._common(self)
+        ignored_spans = file_index._postings[_posting_rows(file_index._offsets, idxs)]
 
         # Nothing to ignore
-        if not ignored_spans:
+        if not len(ignored_spans):
             return [tokens]
 
         # Find relevant tokens (any token not completely in an ignored_span)
         relevant_token_lists = []
         relevant_tokens = []
-        span_iter = iter(sorted(ignored_spans, key=lambda span: span.start))
-        span = next(span_iter)
+        ignored_spans = ignored_spans[np.argsort(ignored_spans[:, 1], kind="stable")]
+        span_iter = iter(ignored_spans[:, 1:].tolist())
+        span_start, span_end = next(span_iter)
         for i, token in enumerate(tokens):
             # If token comes after span, move on to next span
-            while token.end > span.end:
+            while token.end > span_end:
                 try:
-                    span = next(span_iter)
+                    span_start, span_end = next(span_iter)
                 except StopIteration:
                     relevant_token_lists.append(relevant_tokens + tokens[i:])
                     return relevant_token_lists
 
             # If token starts before the span does, it's relevant
-            if token.start < span.start:
+            if token.start < span_start:
                 relevant_tokens.append(token)
             # If a token is ignored, yield any relevant_tokens so far
             elif relevant_tokens:
@@ -356,17 +1419,25 @@ class CompareIndex(Index):
         if not tokens:
             tokens = file.tokens()
             if not tokens:
-                return []
+                return np.empty(0, dtype=np.uint64), np.empty((0, 3), dtype=np.int64)
 
-        hashes = self.hashes(tokens)
+        if self.engine == "numpy":
+            hashes = self.hash_array(tokens)
+        else:
+            hashes = np.fromiter(self.hashes(tokens), dtype=np.uint64)
 
-        starts = (tok.start for tok in tokens[:-self.k+1])
-        ends = itertools.chain((tok.start for tok in tokens[self.k:]), (tokens[-1].end,))
+        # use all fingerprints instead of sampling
+        postings = np.empty((len(hashes), 3), dtype=np.int64)
+        if len(hashes):
+            postings[:, 0] = file.id
+            postings[:, 1] = [tok.start for tok in tokens[:len(hashes)]]
+            postings[:, 2] = [tok.start for tok in tokens[self.k:]] + [tokens[-1].end]
 
-        fingerprints = []
+        return hashes, postings
 
-        # use all fingerprints instead of sampling
-        for start, end, hash_ in zip(starts, ends, hashes):
-            fingerprints.append((hash_, Span(file, start, end)))
+    def _spans(self, rows):
+        return [Span(self._files[file_id], start, end)
+                for file_id, start, end in self._postings[rows].tolist()]
 
-        return fingerprints
+    def _decode(self, postings):
+        return {Span(self._files[file_id], start, end) for file_id, start, end in postings.tolist()}
@@ -1,10 +1,25 @@
 import unittest
 import tempfile
 import os
+import multiprocessing
+import types
+import unittest.mock
+
+import numpy as np
 
 import compare50._data as data
 import compare50._api as api
 
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.working_directory = tempfile.TemporaryDirectory()
+        self._wd = os.getcwd()
+        os.chdir(self.working_directory.name)
+
+    def tearDown(self):
+        self.working_directory.cleanup()
+        os.chdir(self._wd)
+
 class TestCreateSpans(unittest.TestCase):
     pass
 
@@ -60,6 +75,24 @@ class TestGroupSpans(unittest.TestCase):
         self.assertEqual(set(groups), {data.Group(spans_1), data.Group(spans_2)})
 
 
+    def test_long_chain_single_group(self):
+        # More matches than the recursion limit, (0,1) (1,2) ... (4999,5000)
+        spans = [self.span(i) for i in range(5001)]
+        groups = api._group_span_matches(list(zip(spans, spans[1:])))
+        self.assertEqual(groups, [data.Group(spans)])
+
+    def test_subsumed_groups(self):
+        file = data.Submission(".", ["bar/foo"]).files[0]
+        big = [data.Span(file, 0, 10), data.Span(file, 20, 30)]
+        small = [data.Span(file, 2, 5), data.Span(file, 22, 25)]
+        elsewhere = [data.Span(file, 2, 5), data.Span(file, 40, 45)]
+
+        groups = api._group_span_matches([tuple(big), tuple(small)])
+        self.assertEqual(groups, [data.Group(big)])
+
+        groups = api._group_span_matches([tuple(big), tuple(elsewhere)])
+        self.assertEqual(set(groups), {data.Group(big), data.Group(elsewhere)})
+
 class TestFlatten(unittest.TestCase):
     def span(self, start, end):
         file = data.Submission(".", ["bar/foo"]).files[0]
@@ -100,6 +133,216 @@ class TestFlatten(unittest.TestCase):
         self.assertEqual(api._flatten_spans([span_1, span_2]), [resulting_span])
 
 
+class TestExpand(unittest.TestCase):
+    def setUp(self):
+        self.file_a = data.Submission("a", ["foo"]).files[0]
+        self.file_b = data.Submission("b", ["foo"]).files[0]
+
+    def tokens(self, vals):
+        # Every token is one character, followed by a space
+        return [data.Token(start=2 * i, end=2 * i + 1, type="foo", val=val) for i, val in enumerate(vals)]
+
+    def match(self, start_a, start_b, k=2):
+        return (data.Span(self.file_a, 2 * start_a, 2 * (start_a + k)),
+                data.Span(self.file_b, 2 * start_b, 2 * (start_b + k)))
+
+    def test_expands_to_maximal_match(self):
+        tokens_a, tokens_b = self.tokens("xabcdey"), self.tokens("zabcdew")
+        expanded = api.expand([self.match(2, 2)], tokens_a, tokens_b)
+        self.assertEqual(expanded, [(data.Span(self.file_a, 2, 11), data.Span(self.file_b, 2, 11))])
+
+    def test_expands_to_end_of_file(self):
+        tokens_a, tokens_b = self.tokens("xabcd"), self.tokens("abcd")
+        expanded = api.expand([self.match(1, 0)], tokens_a, tokens_b)
+        self.assertEqual(expanded, [(data.Span(self.file_a, 2, 9), data.Span(self.file_b, 0, 7))])
+
+    def test_one_span_pair_per_stretch(self):
+        tokens_a, tokens_b = self.tokens("abcdxabcd"), self.tokens("abcd")
+        # Overlapping matches on the same diagonal expand to the same span pair
+        expanded = api.expand([self.match(i, i) for i in range(3)] + [self.match(i + 5, i) for i in range(3)],
+                              tokens_a, tokens_b)
+        self.assertEqual(sorted(expanded, key=lambda match: match[0].start),
+                         [(data.Span(self.file_a, 0, 7), data.Span(self.file_b, 0, 7)),
+                          (data.Span(self.file_a, 10, 17), data.Span(self.file_b, 0, 7))])
+
+    def test_tokens_of_different_types(self):
+        # Fingerprints only hash the values of tokens, so neither does expanding
+        tokens_a, tokens_b = self.tokens("xabcdey"), self.tokens("zabcdew")
+        for token in tokens_b[1:3]:
+            token.type = "bar"
+        expanded = api.expand([self.match(3, 3)], tokens_a, tokens_b)
+        self.assertEqual(expanded, [(data.Span(self.file_a, 2, 11), data.Span(self.file_b, 2, 11))])
+
+    def test_match_beyond_expanded_span(self):
+        tokens_a, tokens_b = self.tokens("abxde"), self.tokens("abyde")
+        # The second match starts within the span pair of the first, but ends past it
+        expanded = api.expand([self.match(0, 0), self.match(1, 1, k=4)], tokens_a, tokens_b)
+        self.assertEqual(expanded, [(data.Span(self.file_a, 0, 3), data.Span(self.file_b, 0, 3)),
+                                    (data.Span(self.file_a, 0, 9), data.Span(self.file_b, 0, 9))])
+
+    def test_common_prefix_length(self):
+        self.assertEqual(api._common_prefix_length(np.array([1, 2, 3]), np.array([1, 2, 4, 5])), 2)
+        self.assertEqual(api._common_prefix_length(np.array([1, 2]), np.array([1, 2, 3])), 2)
+        self.assertEqual(api._common_prefix_length(np.array([], dtype=np.int64), np.array([1])), 0)
+
+class TestTokenCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar():\n    print('qux')\n")
+
+        self.file = data.Submission(".", ["foo.py"]).files[0]
+
+    def test_lexes_once(self):
+        with api.token_cache():
+            tokens = self.file.unprocessed_tokens()
+            with open("foo.py", "w") as f:
+                f.write("x = 1\n")
+
+            cached_tokens = self.file.unprocessed_tokens()
+            self.assertEqual(cached_tokens, tokens)
+            self.assertEqual([(tok.start, tok.end, tok.type) for tok in cached_tokens],
+                             [(tok.start, tok.end, tok.type) for tok in tokens])
+            self.assertIs(cached_tokens[0].type, tokens[0].type)
+
+            # Preprocessors may change tokens, which should not affect the cache
+            cached_tokens[0].val = "foo"
+            self.assertEqual(self.file.unprocessed_tokens(), tokens)
+
+        self.assertNotEqual(self.file.unprocessed_tokens(), tokens)
+
+class TestContentCache(TestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("foo.py", "bar.py", "baz.py"):
+            with open(name, "w", newline="") as f:
+                f.write(f"# {name}\r\nprint('qux')\n")
+
+        self.files = data.Submission(".", ["foo.py", "bar.py", "baz.py"]).files
+        self.contents = [file.read() for file in self.files]
+
+    def test_reads_once(self):
+        with api.content_cache():
+            self.assertEqual([file.read() for file in self.files], self.contents)
+            for file in self.files:
+                file.path.unlink()
+            self.assertEqual([file.read() for file in self.files], self.contents)
+            self.assertEqual(self.files[0].read(4), self.contents[0][:4])
+
+    def test_least_recently_read_are_evicted(self):
+        with api.content_cache(max_size=2 * len(self.contents[0])):
+            self.files[0].read()
+            self.files[1].read()
+            self.files[0].read()
+            self.files[2].read()
+
+            with open("foo.py", "w") as f, open("bar.py", "w") as g:
+                f.write("foo")
+                g.write("bar")
+            self.assertEqual(self.files[0].read(), self.contents[0])
+            self.assertEqual(self.files[1].read(), "bar")
+
+    def test_mmap(self):
+        with api.content_cache(mmap_size=0):
+            with unittest.mock.patch.object(data, "_decode", wraps=data._decode) as decode:
+                self.assertEqual([file.read() for file in self.files], self.contents)
+                self.assertEqual([file.read() for file in self.files], self.contents)
+            self.assertEqual(decode.call_count, len(self.files))
+
+    def test_workers_start_with_contents(self):
+        # Files are sent to workers, so need a preprocessor that pickles
+        files = data.Submission(".", ["foo.py", "bar.py", "baz.py"], preprocessor=data.Preprocessor([])).files
+        with api.content_cache():
+            digests = [file.digest() for file in files]
+            for file in files:
+                file.path.unlink()
+            with api.Executor(max_workers=1) as executor:
+                self.assertEqual(list(executor.map(data.File.read, files)), self.contents)
+                self.assertEqual(list(executor.map(data.File.digest, files)), digests)
+
+    def test_only_forked_workers_start_with_contents(self):
+        with api.content_cache():
+            with api.Executor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                self.assertIsNone(executor.submit(getattr, data.File, "_content_cache").result())
+
+class TestCompareIgnoredSpans(TestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("a", "b"):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write("def bar():\n    print('qux')\n")
+
+        self.sub_a, self.sub_b = (data.Submission(name, ["foo.py"]) for name in ("a", "b"))
+        self.score = data.Score(self.sub_a, self.sub_b, 1)
+
+    def compare(self, ignored_spans):
+        comparator = unittest.mock.Mock()
+        comparator.compare.return_value = [data.Comparison(self.sub_a, self.sub_b, [], ignored_spans)]
+        result, = api.compare([self.score], [], types.SimpleNamespace(comparator=comparator))
+        return result.ignored_spans
+
+    def test_list_is_divided_and_flattened_per_file(self):
+        file_a, file_b = self.sub_a.files[0], self.sub_b.files[0]
+        ignored_spans = [data.Span(file_b, 4, 8), data.Span(file_a, 0, 3), data.Span(file_a, 2, 6)]
+        self.assertEqual(self.compare(ignored_spans), [data.Span(file_a, 0, 6), data.Span(file_b, 4, 8)])
+
+    def test_mapping_is_used_as_is(self):
+        file_a, file_b = self.sub_a.files[0], self.sub_b.files[0]
+        ignored_spans = {file_a: [data.Span(file_a, 0, 3)], file_b: [data.Span(file_b, 2, 6)]}
+        self.assertEqual(self.compare(ignored_spans), [data.Span(file_a, 0, 3), data.Span(file_b, 2, 6)])
+
+class TestCompareLazily(TestCase):
+    def setUp(self):
+        super().setUp()
+        subs = []
+        for name in "abcde":
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(f"def {name}():\n    print('qux')\n")
+            subs.append(data.Submission(name, ["foo.py"]))
+
+        self.scores = [data.Score(sub_a, sub_b, i) for i, (sub_a, sub_b) in enumerate(zip(subs, subs[1:]))]
+
+        comparisons = lambda scores, ignored_files: \
+            [data.Comparison(score.sub_a, score.sub_b, [], {}) for score in scores]
+        comparator = unittest.mock.Mock(spec=["compare", "iter_compare"])
+        comparator.compare.side_effect = comparisons
+        comparator.iter_compare.side_effect = lambda scores, ignored_files: iter(comparisons(scores, ignored_files))
+        self.pass_ = types.SimpleNamespace(comparator=comparator, preprocessors=[])
+
+    def test_equals_compare(self):
+        results = api.compare_lazily(self.scores, [], self.pass_, batch_size=3)
+        self.assertEqual(len(results), len(self.scores))
+        self.assertEqual(list(results), api.compare(self.scores, [], self.pass_))
+
+    def test_iterates_once(self):
+        results = api.compare_lazily(self.scores, [], self.pass_, batch_size=3)
+        self.pass_.comparator.iter_compare.assert_not_called()
+
+        self.assertEqual([result.score for result in results], self.scores)
+        self.pass_.comparator.iter_compare.assert_called_once_with(self.scores, [])
+
+        # Unless going back
+        self.assertEqual(results[0].score, self.scores[0])
+        self.assertEqual(self.pass_.comparator.iter_compare.call_count, 2)
+        self.pass_.comparator.compare.assert_not_called()
+
+    def test_compares_per_batch(self):
+        del self.pass_.comparator.iter_compare
+        results = api.compare_lazily(self.scores, [], self.pass_, batch_size=3)
+        self.pass_.comparator.compare.assert_not_called()
+
+        self.assertEqual(results[1].score, self.scores[1])
+        self.pass_.comparator.compare.assert_called_once_with(self.scores[:3], [])
+
+        self.assertEqual(results[-1].score, self.scores[-1])
+        self.pass_.comparator.compare.assert_called_with(self.scores[3:], [])
+        self.assertEqual(self.pass_.comparator.compare.call_count, 2)
+
+        with self.assertRaises(IndexError):
+            results[len(self.scores)]
+
 class TestMissingSpans(unittest.TestCase):
     def setUp(self):
         self.working_directory = tempfile.TemporaryDirectory()
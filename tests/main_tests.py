@@ -2,6 +2,9 @@ import unittest
 import tempfile
 import os
 import io
+import shutil
+import tarfile
+import zipfile
 from unittest.mock import patch
 import compare50.__main__ as main
 import compare50._api as api
@@ -111,6 +114,134 @@ class TestSubmissionFactory(TestCase):
         subs = {sub for sub in subs if sub.files}
         self.assertEqual(subs, set())
 
+    def test_large_file(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/bar.py", "w") as f:
+            f.write("x" * 11)
+        with open("foo/baz.py", "w") as f:
+            f.write("x" * 10)
+
+        self.factory.max_file_size = 10
+        sub, = self.factory.get_all(["foo"], preprocessor)
+        self.assertEqual([str(file.name) for file in sub.files], ["baz.py"])
+        self.assertEqual([str(name) for name in sub.large_files], ["bar.py"])
+
+    def test_contents_read_once(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/bar.py", "w") as f:
+            f.write("x = 1\n")
+
+        with api.content_cache():
+            sub, = self.factory.get_all(["foo"], preprocessor)
+            os.remove("foo/bar.py")
+            self.assertEqual(sub.files[0].read(), "x = 1\n")
+            self.assertEqual(sub.files[0].digest(), sub.files[0].digest())
+
+    def test_zip_submission(self):
+        preprocessor = lambda tokens : tokens
+        with zipfile.ZipFile("foo.zip", "w") as archive:
+            archive.writestr("bar.py", "x = 1\r\n")
+            archive.writestr("baz/qux.c", "int x;\n")
+            archive.writestr("baz/.hidden.c", "int y;\n")
+            archive.writestr("baz/large.c", "int z;\n" * 10)
+            archive.writestr("../outside.py", "y = 2\n")
+
+        self.factory.exclude("*.py")
+        self.factory.max_file_size = 50
+        sub, = self.factory.get_all(["foo.zip"], preprocessor)
+        self.assertEqual(str(sub.path), "foo.zip")
+        self.assertEqual([str(file.name) for file in sub.files], ["baz/qux.c"])
+        self.assertEqual([str(name) for name in sub.large_files], ["baz/large.c"])
+        self.assertEqual(sub.files[0].read(), "int x;\n")
+
+        self.factory.include("bar.py")
+        with api.content_cache():
+            sub, = self.factory.get_all(["foo.zip"], preprocessor)
+            os.remove("foo.zip")
+            self.assertEqual([file.read() for file in sub.files], ["x = 1\n", "int x;\n"])
+
+    def test_tar_submission(self):
+        preprocessor = lambda tokens : tokens
+        os.mkdir("foo")
+        with open("foo/bar.py", "w") as f:
+            f.write("x = 1\n")
+        with open("foo/baz.py", "wb") as f:
+            f.write(b"\x80abc")
+        with tarfile.open("foo.tar.gz", "w:gz") as archive:
+            archive.add("foo/bar.py", arcname="bar.py")
+            archive.add("foo/baz.py", arcname="baz.py")
+        shutil.rmtree("foo")
+
+        sub, = self.factory.get_all(["foo.tar.gz"], preprocessor)
+        self.assertEqual([str(file.name) for file in sub.files], ["bar.py"])
+        self.assertEqual([str(name) for name in sub.undecodable_files], ["baz.py"])
+        self.assertEqual(sub.files[0].read(), "x = 1\n")
+        self.assertEqual([tok.val for tok in sub.files[0].tokens()][:3], ["x", " ", "="])
+
+    def test_tar_submission_decompressed_once(self):
+        preprocessor = lambda tokens : tokens
+        with tarfile.open("foo.tar.gz", "w:gz") as archive:
+            for i in range(10):
+                info = tarfile.TarInfo(f"bar{i}.py")
+                info.size = len(f"x = {i}\n")
+                archive.addfile(info, io.BytesIO(f"x = {i}\n".encode()))
+
+        sub, = self.factory.get_all(["foo.tar.gz"], preprocessor)
+        with patch("tarfile.open", side_effect=tarfile.open) as open_:
+            self.assertEqual([file.read() for file in sub.files], [f"x = {i}\n" for i in range(10)])
+        self.assertEqual(open_.call_count, 1)
+
+    def test_split_archive(self):
+        preprocessor = lambda tokens : tokens
+        with tarfile.open("semester.tar.gz", "w:gz") as archive:
+            for name, content in [("alice/foo.py", "x = 1\n"), ("bob/foo.py", "x = 2\n"),
+                                  ("bob/lib/bar.py", "y = 2\n"), ("bob/notes.txt", "todo\n"),
+                                  ("README", "semester\n")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content.encode()))
+
+        self.factory.split_archives = True
+        self.factory.exclude("*.txt")
+        subs = sorted(self.factory.get_all(["semester.tar.gz"], preprocessor), key=lambda sub: sub.id)
+        self.assertEqual([str(sub.path) for sub in subs], ["semester.tar.gz/alice", "semester.tar.gz/bob"])
+        self.assertEqual([[str(file.name) for file in sub.files] for sub in subs],
+                         [["foo.py"], ["foo.py", "lib/bar.py"]])
+        self.assertEqual([file.read() for sub in subs for file in sub.files], ["x = 1\n", "x = 2\n", "y = 2\n"])
+
+    def test_archive_files_match_lib50(self):
+        # Archive members are matched by name, which should include the same files as lib50 does on disk
+        names = ["foo.py", "bar.c", "Makefile", ".env", "src/baz.c", "src/qux.py", "src/lib/x.c",
+                 ".hidden/y.py", "src/.hidden/z.c", "a/b/c/d.txt"]
+        for name in names:
+            os.makedirs(os.path.dirname(name) or ".", exist_ok=True)
+            open(name, "w").close()
+
+        patterns = [[], [("exclude", "*")], [("exclude", "*"), ("include", "*.c")],
+                    [("exclude", "src"), ("include", "src/**/*.c")], [("include", ".hidden/*")],
+                    [("exclude", "*.py"), ("include", "src/*")], [("include", ".*"), ("exclude", "a/*")],
+                    [("exclude", "**"), ("include", "*/baz.c"), ("include", "Makefile")]]
+        for pattern in patterns:
+            factory = main.SubmissionFactory()
+            for tag, value in pattern:
+                (factory.include if tag == "include" else factory.exclude)(value)
+            included, _ = main.lib50.files(factory.patterns, require_tags=[], root=".")
+            self.assertEqual(factory._files(names), included, pattern)
+
+    def test_submissions_in_order_of_paths(self):
+        preprocessor = lambda tokens : tokens
+        paths = [f"foo{i}" for i in range(40)]
+        for path in paths:
+            os.mkdir(path)
+            with open(os.path.join(path, "bar.py"), "w") as f:
+                f.write(path)
+
+        subs = sorted(self.factory.get_all(paths, preprocessor), key=lambda sub: sub.id)
+        self.assertEqual([str(sub.path) for sub in subs], paths)
+        self.assertTrue(all(len(sub.files) == 1 for sub in subs))
+
     def test_permission_error(self):
         os.mkdir("foo")
         file_path = "foo/bar.py"
@@ -118,7 +249,7 @@ class TestSubmissionFactory(TestCase):
             f.write("test content")
         os.chmod(file_path, 0o000)
         with self.assertRaises(PermissionError):
-            main.SubmissionFactory._is_valid_utf8(file_path)
+            self.factory._read(file_path)
         os.chmod(file_path, 0o644)
     
     def test_excepthook_permission_error(self):
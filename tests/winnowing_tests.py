@@ -1,10 +1,18 @@
+import heapq
+import io
 import unittest
 import tempfile
 import os
+import shutil
 import sys
+import unittest.mock
+
+import numpy as np
 
 import compare50.comparators._winnowing as winnowing
+import compare50.comparators._suffix_array as suffix_array_
 import compare50._data as data
+import compare50._api as api
 
 class TestCase(unittest.TestCase):
     def setUp(self):
@@ -16,6 +24,30 @@ class TestCase(unittest.TestCase):
         self.working_directory.cleanup()
         os.chdir(self._wd)
 
+class ComparatorTestCase(TestCase):
+    """ Runs comparators with the progress bar disabled, in this process unless
+    ``in_process`` is False. """
+    in_process = True
+
+    def setUp(self):
+        super().setUp()
+        api.progress_bar("foo", disable=True).__enter__()
+        self._executor = api.Executor
+        if self.in_process:
+            api.Executor = api.FauxExecutor
+
+    def tearDown(self):
+        super().tearDown()
+        api.Executor = self._executor
+        api._progress_bar.close()
+
+    def count_fingerprints(self, score, *args):
+        """ Returns ``score(*args)`` and the number of files it fingerprinted. """
+        with unittest.mock.patch.object(winnowing.ScoreIndex, "fingerprint", autospec=True,
+                                        side_effect=winnowing.ScoreIndex.fingerprint) as fingerprint:
+            return score(*args), fingerprint.call_count
+
+
 class TestCompareIndexIgnoreTokens(TestCase):
     def setUp(self):
         super().setUp()
@@ -58,6 +90,462 @@ class TestCompareIndexIgnoreTokens(TestCase):
         self.assertEqual(relevant_token_lists[0], expected_tokens)
 
 
+class TestScoreIndexCompare(ComparatorTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = "def bar():\n"\
+                       "    print('qux')\n"\
+                       "    return 1 + 2\n"
+
+        self.subs = []
+        for name in ("a", "b", "c"):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(self.content if name != "c" else "x\n")
+            self.subs.append(data.Submission(name, ["foo.py"]))
+
+    def test_scores_only_matching_pairs(self):
+        index = winnowing.ScoreIndex(k=2, t=3)
+        for sub in self.subs:
+            for file in sub.files:
+                index.include(file)
+
+        scores = index.compare(index)
+        self.assertEqual(len(scores), 1)
+        sub_a, sub_b = self.subs[:2]
+        self.assertEqual((scores[0].sub_a, scores[0].sub_b), (sub_a, sub_b))
+
+        # Every fingerprint of a is shared with b
+        index_a = winnowing.ScoreIndex(k=2, t=3)
+        index_a.include(sub_a.files[0])
+        self.assertEqual(scores[0].score, len(index_a.keys()))
+
+    def test_pair_scores_sum_duplicates(self):
+        pair_scores = winnowing._PairScores(width=10)
+        pair_scores.add(np.array([1, 2]), np.array([3, 4]), 1.5)
+        pair_scores.add(np.array([1]), np.array([3]), 2)
+        self.assertEqual(list(pair_scores.items()), [(1, 3, 3.5), (2, 4, 1.5)])
+
+    def test_shards_sum_to_the_same_scores(self):
+        index = winnowing.ScoreIndex(k=2, t=3)
+        for sub in self.subs:
+            for file in sub.files:
+                index.include(file)
+        idxs, other_idxs = index._common(index)
+        weights = winnowing._to_fixed_point(np.linspace(0.5, 2, len(idxs)))
+
+        def score(shards):
+            pair_scores = winnowing._PairScores(width=10)
+            for shard in shards:
+                pair_scores.merge(*winnowing._score_shard((
+                    *winnowing._shard_postings(index._offsets, index._postings, idxs[shard]),
+                    *winnowing._shard_postings(index._offsets, index._postings, other_idxs[shard]),
+                    np.ones(len(idxs))[shard].astype(np.int64), weights[shard], 10)))
+            return list(pair_scores.items())
+
+        expected = score([slice(0, len(idxs))])
+        self.assertEqual(len(expected), 1)
+        self.assertEqual(score([slice(i, i + 1) for i in reversed(range(len(idxs)))]), expected)
+
+    def test_nlargest_matches_heapq(self):
+        ids = [sub.id for sub in self.subs]
+        pairs = [(id1, id2) for id1 in ids for id2 in ids] * 3
+        ids1, ids2 = np.array(pairs).T
+        values = np.random.default_rng(0).integers(1, 4, len(pairs)).astype(np.float64)
+        scores = winnowing._Scores(ids1, ids2, values)
+
+        key = lambda score: (score.sub_a, score.sub_b, score.score)
+        for n in range(len(pairs) + 2):
+            self.assertEqual([key(score) for score in scores.nlargest(n)],
+                             [key(score) for score in heapq.nlargest(n, scores)])
+
+
+class TestMaxDocumentFrequency(ComparatorTestCase):
+    def setUp(self):
+        super().setUp()
+
+        for name, content in (("a", "int x = 1;\n"), ("b", "int x = 1;\n"), ("c", "int x = 1;\n"), ("d", "y\n")):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.c"), "w") as f:
+                f.write(content)
+        self.subs = [data.Submission(name, ["foo.c"]) for name in "abcd"]
+
+    def test_drop_frequent(self):
+        index = winnowing.ScoreIndex(k=2, t=2)
+        for sub in self.subs:
+            index.include(sub.files[0])
+        n_hashes = len(index.keys())
+
+        # Only the fingerprint of d occurs in fewer than 3 submissions
+        self.assertEqual(index.drop_frequent(2), n_hashes - 1)
+        self.assertEqual(index.values(), [{self.subs[3].id}])
+
+    def test_ceiling(self):
+        with unittest.mock.patch("sys.stdout", new_callable=io.StringIO) as stdout, \
+             unittest.mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            self.assertEqual(len(winnowing.Winnowing(k=2, t=2).score(self.subs, [], [])), 3)
+            self.assertEqual(len(winnowing.Winnowing(k=2, t=2, max_df=3).score(self.subs, [], [])), 3)
+            self.assertEqual(len(winnowing.Winnowing(k=2, t=2, max_df=2).score(self.subs, [], [])), 0)
+            self.assertEqual(len(winnowing.Winnowing(k=2, t=2, max_df=0.75).score(self.subs, [], [])), 3)
+            self.assertEqual(len(winnowing.Winnowing(k=2, t=2, max_df=0.5).score(self.subs, [], [])), 0)
+
+        # Without a bar showing, the fingerprints ignored are reported on stderr only
+        self.assertEqual(stdout.getvalue(), "")
+        self.assertIn("Ignoring", stderr.getvalue())
+
+
+class TestDuplicateFiles(ComparatorTestCase):
+    def setUp(self):
+        super().setUp()
+
+        contents = {"a": "int x = 1;\n", "b": "int x = 1;\n", "c": "int x = 1;\n", "d": "int y = 2;\n"}
+        for name, content in contents.items():
+            os.mkdir(name)
+            for file_name in ("foo.c", "foo.py"):
+                with open(os.path.join(name, file_name), "w") as f:
+                    f.write(content)
+
+    def score(self, subs):
+        scores, n_fingerprints = self.count_fingerprints(winnowing.Winnowing(k=2, t=2).score, subs, [], [])
+        return sorted((score.sub_a.path.name, score.sub_b.path.name, score.score) for score in scores), n_fingerprints
+
+    def test_fingerprinted_once(self):
+        subs = [data.Submission(name, ["foo.c", "foo.py"]) for name in "abcd"]
+
+        # Identical contents are only fingerprinted once per lexer
+        scores, n_fingerprints = self.score(subs)
+        self.assertEqual(n_fingerprints, 4)
+
+        # But still count for every submission they're in
+        with unittest.mock.patch.object(winnowing, "_content_digest", side_effect=lambda file: str(file.path)):
+            self.assertEqual(self.score(subs), (scores, 8))
+
+
+class TestArchiveCache(ComparatorTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.content = "def bar():\n"\
+                       "    print('qux')\n"\
+                       "    return 1 + 2\n"
+
+        for name in ("a", "b", "x", "y"):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(self.content if name != "b" else "x\n")
+
+    def score(self, comparator, preprocessor=lambda tokens: tokens):
+        subs = [data.Submission(name, ["foo.py"], preprocessor=preprocessor) for name in ("a", "b")]
+        archive = [data.Submission(name, ["foo.py"], preprocessor=preprocessor, is_archive=True)
+                   for name in ("x", "y")]
+        scores, n_fingerprints = self.count_fingerprints(comparator.score, subs, archive, [])
+        return sorted((score.sub_a.path.name, score.sub_b.path.name, score.score) for score in scores), n_fingerprints
+
+    def test_reuses_archive(self):
+        expected, _ = self.score(winnowing.Winnowing(k=2, t=3))
+        comparator = winnowing.Winnowing(k=2, t=3, archive_cache="cache")
+
+        # x and y are the same, so are fingerprinted once
+        self.assertEqual(self.score(comparator), (expected, 3))
+        self.assertEqual(self.score(comparator), (expected, 2))
+
+    def test_invalidated_by_changes(self):
+        comparator = winnowing.Winnowing(k=2, t=3, archive_cache="cache")
+        self.score(comparator)
+
+        # Different preprocessors
+        scores, n_fingerprints = self.score(comparator, preprocessor=data.Preprocessor([]))
+        self.assertEqual(n_fingerprints, 3)
+
+        # Different archive
+        with open(os.path.join("y", "foo.py"), "w") as f:
+            f.write("y\n")
+        expected, _ = self.score(winnowing.Winnowing(k=2, t=3), preprocessor=data.Preprocessor([]))
+        self.assertEqual(self.score(comparator, preprocessor=data.Preprocessor([])), (expected, 4))
+
+
+class TestIncremental(ComparatorTestCase):
+    def setUp(self):
+        super().setUp()
+
+        contents = {
+            "a": "def bar():\n    print('qux')\n    return 1 + 2\n",
+            "b": "def bar():\n    print('qux')\n    return 3\n",
+            "c": "def foo():\n    print('qux')\n    return 1 + 2\n",
+            "x": "def bar():\n    print('baz')\n    return 1 + 2\n",
+            "y": "def foo():\n    print('qux')\n    return 3\n",
+        }
+        for name, content in contents.items():
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(content)
+
+    def score(self, comparator, names, archive_names):
+        subs = [data.Submission(name, ["foo.py"]) for name in names]
+        archive = [data.Submission(name, ["foo.py"], is_archive=True) for name in archive_names]
+        scores, n_fingerprints = self.count_fingerprints(comparator.score, subs, archive, [])
+        return [(score.sub_a.path.name, score.sub_b.path.name, score.score) for score in scores.nlargest(10)], \
+               n_fingerprints
+
+    def test_matches_full_run(self):
+        for max_df in (None, 2, 0.5):
+            comparator = winnowing.Winnowing(k=2, t=3, max_df=max_df, incremental=f"state{max_df}")
+            full = winnowing.Winnowing(k=2, t=3, max_df=max_df)
+
+            self.assertEqual(self.score(comparator, "ab", "x"), (self.score(full, "ab", "x")[0], 3))
+            self.assertEqual(self.score(comparator, "abc", "xy"), (self.score(full, "abc", "xy")[0], 2))
+            self.assertEqual(self.score(comparator, "abc", "xy"), (self.score(full, "abc", "xy")[0], 0))
+
+    def test_changed_submission(self):
+        comparator = winnowing.Winnowing(k=2, t=3, incremental="state")
+        self.score(comparator, "ab", "x")
+        with open(os.path.join("a", "foo.py"), "a") as f:
+            f.write("x = 1\n")
+        self.assertEqual(self.score(comparator, "abc", "x"),
+                         (self.score(winnowing.Winnowing(k=2, t=3), "abc", "x")[0], 4))
+
+
+class TestWinnowingCompare(ComparatorTestCase):
+    in_process = False
+
+    def setUp(self):
+        super().setUp()
+
+        contents = {
+            "a": "def bar():\n    print('qux')\n    return 1 + 2\n",
+            "b": "def bar():\n    print('qux')\n    return 3\n",
+            "c": "def foo():\n    print('qux')\n    return 1 + 2\n",
+        }
+        for name, content in contents.items():
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(content)
+        self.subs = {name: data.Submission(name, ["foo.py"], preprocessor=data.Preprocessor([]))
+                     for name in contents}
+
+    def compare(self, scores):
+        comparisons = winnowing.Winnowing(k=2, t=3).compare(scores, [])
+        return [(comparison.sub_a, comparison.sub_b, sorted((span_a.file, span_a.start, span_a.end,
+                                                             span_b.file, span_b.start, span_b.end)
+                                                            for span_a, span_b in comparison.span_matches))
+                for comparison in comparisons]
+
+    def test_in_order_of_score(self):
+        scores = [data.Score(self.subs[a], self.subs[b], score) for a, b, score in (("a", "c", 3), ("a", "b", 2), ("b", "c", 1))]
+        comparisons = self.compare(scores)
+        self.assertEqual([(sub_a, sub_b) for sub_a, sub_b, _ in comparisons],
+                         [(score.sub_a, score.sub_b) for score in scores])
+
+        # Spans refer to the files of the compared submissions themselves
+        for sub_a, sub_b, span_matches in comparisons:
+            self.assertTrue(span_matches)
+            for file_a, _, _, file_b, _, _ in span_matches:
+                self.assertIn(file_a, sub_a.files)
+                self.assertIn(file_b, sub_b.files)
+
+        with unittest.mock.patch.object(api, "Executor", api.FauxExecutor):
+            self.assertEqual(self.compare(scores), comparisons)
+
+
+    def test_matches_stay_within_regions(self):
+        distro = "x = [1, 2, 3]\n"
+        before, after = "def bar():\n    print('qux')\n", "def baz():\n    return 1 + 2\n"
+        for name in ("d", "e"):
+            os.mkdir(name)
+            with open(os.path.join(name, "foo.py"), "w") as f:
+                f.write(before + distro + after)
+        with open("distro.py", "w") as f:
+            f.write(distro)
+
+        sub_d, sub_e = (data.Submission(name, ["foo.py"], preprocessor=data.Preprocessor([])) for name in "de")
+        ignored_files = data.Submission(".", ["distro.py"], preprocessor=data.Preprocessor([])).files
+
+        with unittest.mock.patch.object(api, "Executor", api.FauxExecutor):
+            comparison, = winnowing.Winnowing(k=2, t=3).compare([data.Score(sub_d, sub_e, 1)], ignored_files)
+
+        spans = sorted((span_a.start, span_a.end, span_b.start, span_b.end)
+                       for span_a, span_b in comparison.span_matches)
+        self.assertIn((0, len(before), 0, len(before)), spans)
+
+        # No match reaches into the distro code
+        for start_a, end_a, start_b, end_b in spans:
+            for start, end in ((start_a, end_a), (start_b, end_b)):
+                self.assertTrue(end <= len(before) or start >= len(before + distro))
+
+    def test_compared_lazily_prepares_once(self):
+        scores = [data.Score(self.subs[a], self.subs[b], score) for a, b, score in (("a", "c", 3), ("a", "b", 2), ("b", "c", 1))]
+        pass_ = unittest.mock.Mock(comparator=winnowing.Winnowing(k=2, t=3), preprocessors=[])
+        with unittest.mock.patch.object(api, "Executor", api.FauxExecutor), \
+             unittest.mock.patch.object(winnowing.Winnowing._prepare_file, "__call__", autospec=True,
+                                        side_effect=winnowing.Winnowing._prepare_file.__call__) as prepare:
+            results = api.compare_lazily(scores, [], pass_, batch_size=1)
+            self.assertEqual([result.groups for result in results], [result.groups for result in api.compare(scores, [], pass_)])
+        # Once for each of the 3 files lazily, and once more for each by compare
+        self.assertEqual(prepare.call_count, 6)
+
+    def test_compared_lazily_on_given_executor(self):
+        scores = [data.Score(self.subs[a], self.subs[b], score) for a, b, score in (("a", "c", 3), ("a", "b", 2), ("b", "c", 1))]
+        pass_ = unittest.mock.Mock(comparator=winnowing.Winnowing(k=2, t=3), preprocessors=[])
+        expected = [result.groups for result in api.compare(scores, [], pass_)]
+        with unittest.mock.patch.object(api, "Executor", side_effect=AssertionError("started a pool of its own")):
+            results = api.compare_lazily(scores, [], pass_, batch_size=1, executor=api.FauxExecutor())
+            self.assertEqual([result.groups for result in results], expected)
+
+    def test_duplicate_files_prepared_once(self):
+        shutil.copytree("a", "d")
+        sub_d = data.Submission("d", ["foo.py"], preprocessor=data.Preprocessor([]))
+        with unittest.mock.patch.object(api, "Executor", api.FauxExecutor), \
+             unittest.mock.patch.object(winnowing.Winnowing._prepare_file, "__call__", autospec=True,
+                                        side_effect=winnowing.Winnowing._prepare_file.__call__) as prepare:
+            (sub_a, sub_b, span_matches), = self.compare([data.Score(self.subs["a"], sub_d, 1)])
+        self.assertEqual(prepare.call_count, 1)
+
+        # Spans still refer to the files they are in
+        self.assertIn((sub_a.files[0], 0, 45, sub_d.files[0], 0, 45), span_matches)
+        for file_a, _, _, file_b, _, _ in span_matches:
+            self.assertEqual((file_a, file_b), (sub_a.files[0], sub_d.files[0]))
+
+    def test_suffix_array_match_engine(self):
+        scores = [data.Score(self.subs["a"], self.subs[b], 1) for b in "bc"]
+        comparisons = winnowing.Winnowing(k=2, t=3, match_engine="suffix_array").compare(scores, [])
+        self.assertEqual([[(span_a.start, span_a.end, span_b.start, span_b.end)
+                           for span_a, span_b in sorted(comparison.span_matches, key=lambda match: match[0].start)]
+                          for comparison in comparisons],
+                         [[(0, 39, 0, 39), (10, 15, 27, 32), (27, 32, 10, 15)],
+                          [(0, 4, 0, 4), (7, 45, 7, 45), (10, 15, 27, 32), (27, 32, 10, 15)]])
+
+        with self.assertRaises(ValueError):
+            winnowing.Winnowing(k=2, t=3, match_engine="foo")
+
+
+class TestSuffixArray(unittest.TestCase):
+    def brute_force(self, ids, n, min_length):
+        matches = []
+        for i in range(n):
+            for j in range(n, len(ids)):
+                if i and ids[i - 1] == ids[j - 1]:
+                    continue
+                length = 0
+                while i + length < n and ids[i + length] == ids[j + length]:
+                    length += 1
+                if length >= min_length:
+                    matches.append((i, j, length))
+        return matches
+
+    def test_suffix_array(self):
+        ids = np.array([2, 1, 2, 1, 0, 2, 1, 3])
+        suffix_array, _ = suffix_array_.suffix_array(ids)
+        self.assertEqual(suffix_array.tolist(), sorted(range(len(ids)), key=lambda i: ids[i:].tolist()))
+
+    def test_maximal_matches(self):
+        rng = np.random.default_rng(0)
+        for _ in range(200):
+            a, b = rng.integers(0, 3, size=rng.integers(0, 12)), rng.integers(0, 3, size=rng.integers(0, 12))
+            # Each sequence is followed by an id of its own
+            ids = np.concatenate((a, [3], b, [4]))
+            for min_length in (1, 2, 3):
+                matches = suffix_array_.maximal_matches(ids, len(a) + 1, min_length)
+                self.assertEqual(list(zip(*(array.tolist() for array in matches))),
+                                 self.brute_force(ids.tolist(), len(a) + 1, min_length))
+
+class TestIndex(unittest.TestCase):
+    def index(self, fingerprints):
+        index = winnowing.ScoreIndex(k=2, t=2)
+        for hash_, id in fingerprints:
+            index._pending.append((np.array([hash_], dtype=np.uint64), np.array([[id]]), 0))
+        return index
+
+    def test_merge(self):
+        index = self.index([(5, 1), (3, 2), (5, 0), (5, 1)])
+        index.include_all(self.index([(3, 2), (4, 1)]))
+        self.assertEqual(index.keys().tolist(), [3, 4, 5])
+        self.assertEqual(index.values(), [{2}, {1}, {0, 1}])
+
+    def test_include_all_with_offset(self):
+        index = self.index([(5, 1)])
+        index.include_all(self.index([(5, 0), (3, 1)]), offset=2)
+        self.assertEqual(index.keys().tolist(), [3, 5])
+        self.assertEqual(index.values(), [{3}, {1, 2}])
+
+    def test_ignore_all(self):
+        index = self.index([(1, 0), (2, 0), (2, 1), (3, 1)])
+        index.ignore_all(self.index([(2, 5), (4, 5)]))
+        self.assertEqual(index.keys().tolist(), [1, 3])
+        self.assertEqual(index.values(), [{0}, {1}])
+        self.assertTrue(index)
+
+        index.ignore_all(index)
+        self.assertFalse(index)
+
+    def test_common(self):
+        index = self.index([(1, 0), (2, 0), (5, 0)])
+        other = self.index([(0, 1), (2, 1), (5, 1), (6, 1)])
+        idxs, other_idxs = index._common(other)
+        self.assertEqual(idxs.tolist(), [1, 2])
+        self.assertEqual(other_idxs.tolist(), [1, 2])
+
+
+class TestWinnowArray(unittest.TestCase):
+    def test_matches_winnow(self):
+        rng = np.random.default_rng(0)
+        for w in (1, 2, 5, 11):
+            for n in (0, 1, w - 1, w, w + 1, 200):
+                # Few distinct values, so that there are plenty of ties
+                hashes = rng.integers(0, 8, size=n).astype(np.uint64)
+                self.assertEqual(winnowing._winnow_array(hashes, w).tolist(),
+                                 list(winnowing._winnow(hashes.tolist(), w)))
+
+
+
+class TestHashes(unittest.TestCase):
+    def tokens(self, vals):
+        return [data.Token(i, i + 1, None, val) for i, val in enumerate(vals)]
+
+    def test_stable(self):
+        # Hashes are persisted, so they must not change between runs or releases
+        index = winnowing.ScoreIndex(k=2, t=2)
+        self.assertEqual(list(index.hashes(self.tokens(["int", "x", "="]))),
+                         [3460532754284492035, 3745365491016653396])
+
+    def test_rolling_matches_array(self):
+        index = winnowing.ScoreIndex(k=3, t=3)
+        tokens = self.tokens(["a", "b", "c", "a", "b", "c", "d"])
+        self.assertEqual(list(index.hashes(tokens)), index.hash_array(tokens).tolist())
+        self.assertEqual(list(index.hashes(tokens[:2])), [])
+
+    def test_kgram_boundaries(self):
+        # Unlike hashing the joined string, "ab" "c" and "a" "bc" differ
+        index = winnowing.ScoreIndex(k=2, t=2)
+        self.assertNotEqual(list(index.hashes(self.tokens(["ab", "c"]))),
+                            list(index.hashes(self.tokens(["a", "bc"]))))
+
+
+class TestNumpyEngine(TestCase):
+    def setUp(self):
+        super().setUp()
+        with open("foo.py", "w") as f:
+            f.write("def bar(x):\n"
+                    "    for i in range(x):\n"
+                    "        print('qux', i)\n"
+                    "    return bar(x - 1) + bar(x - 2)\n")
+        self.file = data.Submission(".", ["foo.py"]).files[0]
+
+    def test_score_index_matches_python_engine(self):
+        python_index = winnowing.ScoreIndex(k=3, t=6)
+        python_index.include(self.file)
+        numpy_index = winnowing.ScoreIndex(k=3, t=6, engine="numpy")
+        numpy_index.include(self.file)
+        self.assertEqual(python_index.keys().tolist(), numpy_index.keys().tolist())
+        self.assertEqual(python_index.values(), numpy_index.values())
+
+    def test_compare_index_spans(self):
+        python_index = winnowing.CompareIndex(k=3)
+        python_index.include(self.file)
+        numpy_index = winnowing.CompareIndex(k=3, engine="numpy")
+        numpy_index.include(self.file)
+        self.assertEqual(python_index.keys().tolist(), numpy_index.keys().tolist())
+        self.assertEqual(python_index.values(), numpy_index.values())
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(verbosity=2).run(suite)